@@ -1,13 +1,33 @@
+"""
+HTTP server for versus.html, many browser games at once against one shared NNChess model:
+
+    python api.py [--port 8090] [--model nn.hdf5]
+
+Each browser game is a session. Engine moves of all sessions are computed in micro-batches by InferenceBatcher,
+and are delivered to the browser with long-polling GET /move. GET /metrics reports sessions, batcher statistics
+and per-request latency.
+"""
+import argparse
+import json
 import logging
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-from queue import Queue
-from threading import Thread
+import os
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
 
 from chess import WHITE, BLACK
 
-from chessnn.nn import NN
+from chessnn import BoardOptim
+from chessnn.batcher import InferenceBatcher, LatencyStats
+from chessnn.npnn import load_net
 from chessnn.player import NNPLayer
-from training import play_one_game
+
+POLL_TIMEOUT = 25.0  # s, below usual proxy and browser timeouts, client repeats the poll on 204
+SESSION_TTL = 3600.0  # s of inactivity before a session is dropped
+MAX_BATCH = 64
+MAX_DELAY = 0.005  # s the first move request of a batch may wait for others
 
 
 class PlayerCLI(NNPLayer):
@@ -25,64 +45,187 @@ class PlayerCLI(NNPLayer):
         return move
 
 
-class ChessAPIHandler(SimpleHTTPRequestHandler):
+class GameSession(object):
+    """
+    One browser game, human plays white and the engine plays black
+    """
+
+    def __init__(self, batcher, stats) -> None:
+        super().__init__()
+        self.sid = uuid.uuid4().hex
+        self.board = BoardOptim()
+        self.player = NNPLayer("Karen", BLACK, batcher)
+        self.player.board = self.board
+        self.batcher = batcher
+        self.stats = stats
+        self.cond = threading.Condition()
+        self.touched = time.time()
+        self.requested = None  # when the engine move was requested
+
+    def ply(self):
+        return len(self.board.move_stack)
+
+    def request_move(self):
+        """
+        Queues the engine move, it is made on the board by the batcher thread once the NN answers
+        """
+        self.requested = time.time()
+        self.batcher.submit(self.player.get_inference_record()).add_done_callback(self._make_move)
+
+    def _make_move(self, future):
+        if future.exception():
+            logging.error("No engine move for %s: %s", self.sid, future.exception())
+            return
+
+        with self.cond:
+            move, _, _ = self.player.choice_from_inference(future.result())
+            self.board.push(move)
+            self.stats.add("engine_move", time.time() - self.requested)
+            self.cond.notify_all()
+
+
+class ChessServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # listen() backlog, the default of 5 resets connections when many players move at once
+
+    def __init__(self, server_address, net) -> None:
+        super().__init__(server_address, ChessAPIHandler)
+        self.stats = LatencyStats()
+        self.batcher = InferenceBatcher(net, MAX_BATCH, MAX_DELAY)
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+    def new_session(self):
+        session = GameSession(self.batcher, self.stats)
+        now = time.time()
+        with self.sessions_lock:
+            for sid in [sid for sid, x in self.sessions.items() if now - x.touched > SESSION_TTL]:
+                del self.sessions[sid]
+            self.sessions[session.sid] = session
+        return session
+
+    def get_session(self, sid):
+        with self.sessions_lock:
+            session = self.sessions.get(sid)
+        if session:
+            session.touched = time.time()
+        return session
 
-    def do_GET(self):
-        if self.path != '/move':
-            return super().do_GET()
-
-        logging.debug("Getting move to send...")
-        item = self.server.oqueue.get(True)
-        logging.debug("Sending move: %s", item)
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write(bytes(str(item), 'ascii'))
 
-    def do_POST(self):
-        content_len = int(self.headers.get('Content-Length'))
-        item = self.rfile.read(content_len)
-        item = item.decode('ascii')
-        logging.debug("Received move: %s", item)
-        self.server.iqueue.put(item)
-        self.send_response(202)
-        self.end_headers()
-        self.wfile.write(bytes(str(item), 'ascii'))
+class ChessAPIHandler(SimpleHTTPRequestHandler):
+    server: ChessServer
 
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, directory=os.path.dirname(os.path.abspath(__file__)), **kwargs)
 
-class PlayerAPI(NNPLayer):
+    def log_message(self, fmt, *args):
+        logging.debug("%s - " + fmt, self.address_string(), *args)
 
-    def __init__(self, color) -> None:
-        super().__init__(color, None)
-        server_address = ('', 8090)
-        self.httpd = HTTPServer(server_address, ChessAPIHandler)
-        self.iqueue = Queue()
-        self.oqueue = Queue()
-        self.httpd.iqueue = self.iqueue
-        self.httpd.oqueue = self.oqueue
+    def _reply(self, code, body=b"", content_type="text/plain"):
+        self.send_response(code)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-        self.thr = Thread(target=self.run)
-        self.thr.setDaemon(True)
-        self.thr.start()
+    def _timed(self, name, handler, *args):
+        started = time.time()
+        try:
+            handler(*args)
+        finally:
+            self.server.stats.add(name, time.time() - started)
 
-    def run(self):
-        self.httpd.serve_forever()
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/move':
+            self._timed("GET /move", self._get_move, query)
+        elif url.path == '/metrics':
+            self._timed("GET /metrics", self._get_metrics)
+        else:
+            super().do_GET()
 
-    def _choose_best_move(self):
-        if self.board.move_stack:
-            self.oqueue.put(self.board.move_stack[-1])
-        logging.debug("Getting next move...")
-        move_str = self.iqueue.get(True)
-        return self.board.parse_san(move_str)
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        content_len = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(content_len).decode('ascii')
+        if url.path == '/session':
+            self._timed("POST /session", self._post_session)
+        elif url.path == '/move':
+            self._timed("POST /move", self._post_move, query, body)
+        else:
+            self._reply(404)
+
+    def _session(self, query):
+        session = self.server.get_session(query.get("session", [""])[0])
+        if not session:
+            self._reply(404, b"Unknown session")
+        return session
+
+    def _post_session(self):
+        session = self.server.new_session()
+        logging.info("New session: %s", session.sid)
+        self._reply(200, json.dumps({"session": session.sid}).encode('ascii'), "application/json")
+
+    def _post_move(self, query, item):
+        session = self._session(query)
+        if not session:
+            return
+
+        logging.debug("Received move for %s: %s", session.sid, item)
+        with session.cond:
+            if session.board.turn != WHITE:
+                self._reply(409, b"Not your turn")
+                return
+
+            try:
+                session.board.push_san(item)
+            except ValueError as exc:
+                self._reply(400, bytes(str(exc), 'ascii'))
+                return
+
+            if not session.board.is_game_over(claim_draw=False):
+                session.request_move()
+        self._reply(202, bytes(item, 'ascii'))
+
+    def _get_move(self, query):
+        """
+        Long-poll for the move number "ply" (0-based), replies 204 when it is not made before the poll timeout
+        """
+        session = self._session(query)
+        if not session:
+            return
+
+        ply = int(query.get("ply", ["1"])[0])
+        with session.cond:
+            if not session.cond.wait_for(lambda: session.ply() > ply, POLL_TIMEOUT):
+                self._reply(204)
+                return
+
+            board = session.board.copy()
+            while board.ply() > ply + 1:
+                board.pop()
+            item = board.san(board.pop())
+
+        logging.debug("Sending move for %s: %s", session.sid, item)
+        self._reply(200, bytes(item, 'ascii'))
+
+    def _get_metrics(self):
+        with self.server.sessions_lock:
+            sessions = len(self.server.sessions)
+        metrics = {"sessions": sessions, "latency": self.server.stats.summary(), "batcher": self.server.batcher.stats()}
+        self._reply(200, json.dumps(metrics, indent=2).encode('ascii'), "application/json")
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(description="Serves versus.html games against NNChess")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--model", default="nn.hdf5", help="Keras model, or .npz export to run without TensorFlow")
+    args = parser.parse_args()
 
-    white = PlayerAPI(WHITE)
-    black = NNPLayer(BLACK, NN(True, "nn.hdf5"))
+    logging.basicConfig(level=logging.INFO)
 
-    cnt = 1
-    while True:
-        play_one_game(white, black, cnt)
-        cnt += 1
+    httpd = ChessServer(('', args.port), load_net(args.model))
+    logging.info("Serving on port %s", args.port)
+    httpd.serve_forever()
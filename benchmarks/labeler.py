@@ -0,0 +1,103 @@
+"""
+Throughput of EngineLabeler on random positions, against Stockfish or against a tiny scripted UCI stand-in engine
+that answers instantly, so that only the pool and protocol overhead is measured:
+
+    python benchmarks/labeler.py [--engine stockfish] [--engines 4] [--positions 2000] [--crash-rate 0.001]
+
+With --crash-rate the stand-in exits at random, to exercise engine restarts.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+
+import chess
+import chess.engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from chessnn.labeler import EngineLabeler  # noqa: E402
+
+
+def stand_in_engine(crash_rate):
+    """
+    Minimal UCI engine: plays the first legal move with a material count score
+    """
+    values = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300, chess.ROOK: 500, chess.QUEEN: 900}
+    board = chess.Board()
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        if tokens[0] == "uci":
+            print("id name stand-in\noption name UCI_Chess960 type check default false\nuciok", flush=True)
+        elif tokens[0] == "isready":
+            print("readyok", flush=True)
+        elif tokens[0] == "position":
+            moves = tokens.index("moves") if "moves" in tokens else len(tokens)
+            board = chess.Board(" ".join(tokens[2:moves]), chess960=True) if tokens[1] == "fen" else chess.Board()
+            for move in tokens[moves + 1:]:
+                board.push_uci(move)
+        elif tokens[0] == "go":
+            if random.random() < crash_rate:
+                sys.exit(1)
+            score = sum(value * (len(board.pieces(piece_type, board.turn)) -
+                                 len(board.pieces(piece_type, not board.turn))) for piece_type, value in values.items())
+            move = next(iter(board.legal_moves), None)
+            pv = " pv %s" % move.uci() if move else ""
+            print("info depth 1 nodes 1 score cp %d%s" % (score, pv), flush=True)
+            print("bestmove %s" % (move.uci() if move else "0000"), flush=True)
+        elif tokens[0] == "quit":
+            break
+
+
+def random_boards(count, rng):
+    boards = []
+    while len(boards) < count:
+        board = chess.Board.from_chess960_pos(rng.randint(0, 959))
+        for _ in range(rng.randint(0, 60)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        if not board.is_game_over():
+            boards.append(board)
+    return boards
+
+
+async def run(args):
+    command = args.engine or [sys.executable, os.path.abspath(__file__), "--stand-in", "--crash-rate",
+                              str(args.crash_rate)]
+    boards = random_boards(args.positions, random.Random(42))
+    labeler = EngineLabeler(command, args.engines, chess.engine.Limit(time=args.time))
+    async with labeler:
+        labels = await labeler.label(boards)
+    return {"positions": labeler.positions, "positions_per_sec": labeler.positions_per_sec(),
+            "restarts": labeler.restarts, "failures": labeler.failures,
+            "unlabeled": sum(label is None for label in labels)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engine", help="engine executable, the stand-in engine is used by default")
+    parser.add_argument("--engines", type=int, default=4)
+    parser.add_argument("--positions", type=int, default=2000)
+    parser.add_argument("--time", type=float, default=0.01, help="seconds per position")
+    parser.add_argument("--crash-rate", type=float, default=0.0)
+    parser.add_argument("--stand-in", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stand_in:
+        stand_in_engine(args.crash_rate)
+        return
+
+    logging.basicConfig(level=logging.INFO)
+    json.dump(asyncio.run(run(args)), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Measures cold start of the CLI entry points: module import time and latency of the first NN move,
+each in a fresh interpreter so that nothing is cached between runs.
+
+Usage: python benchmarks/startup.py [--model nn.hdf5] [--repeat 3] [script ...]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+_CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import %(module)s
+imported = time.perf_counter()
+
+from chess import WHITE
+from chessnn import BoardOptim
+from chessnn.nn import NNChess
+from chessnn.player import NNPLayer
+
+player = NNPLayer("bench", WHITE, NNChess(%(model)r))
+player.board = BoardOptim()
+constructed = time.perf_counter()
+player.makes_move(0)
+moved = time.perf_counter()
+json.dump({"import": imported - started, "nn_init": constructed - imported, "first_move": moved - constructed,
+           "total": moved - started, "modules": len(sys.modules)}, sys.stdout)
+"""
+
+
+def measure(script, model):
+    module = os.path.splitext(os.path.basename(script))[0]
+    code = _CHILD % {"module": module, "model": model}
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True, stdout=subprocess.PIPE)
+    return json.loads(out.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scripts", nargs="*", default=["uci.py", "api.py"])
+    parser.add_argument("--model", default="nn.hdf5")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = {}
+    for script in args.scripts:
+        runs = [measure(script, args.model) for _ in range(args.repeat)]
+        results[script] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        logging.info("%s: import %.3fs, NN init %.3fs, first move %.3fs, total %.3fs", script,
+                     results[script]["import"], results[script]["nn_init"], results[script]["first_move"],
+                     results[script]["total"])
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
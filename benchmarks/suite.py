@@ -0,0 +1,223 @@
+"""
+Offline CPU benchmarks of hot paths and of self-play, with a randomly initialized NNChess (fixed seed):
+
+    python benchmarks/suite.py --out results.json [--compare baseline.json --threshold 0.1] [--only board,inference]
+
+Every benchmark reports seconds per call and per item. With --compare, benchmarks slower than the baseline by more
+than the threshold are listed and the exit code is 1.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from chess import WHITE, BLACK
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from chessnn import BoardOptim, MoveRecordStore, MOVES_MAP  # noqa: E402
+from chessnn.archive import GameArchive  # noqa: E402
+from chessnn.player import NNPLayer  # noqa: E402
+
+SEED = 42
+BATCH_SIZES = (1, 32, 256)
+TRAINING_SET_SIZES = (32, 256, 2048)
+GAME_SEEDS = (0, 518, 959)  # Chess960 starting positions, 518 is the standard one
+
+
+def _timeit(func, items=1, min_time=0.5, min_runs=3):
+    """
+    :return: best seconds per call out of runs lasting min_time in total
+    """
+    func()  # warm-up
+    best = float("inf")
+    runs = 0
+    started = time.perf_counter()
+    while runs < min_runs or time.perf_counter() - started < min_time:
+        call_started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - call_started)
+        runs += 1
+    return {"per_call": best, "per_item": best / items, "runs": runs}
+
+
+def _random_boards(count, rng):
+    boards = []
+    while len(boards) < count:
+        board = BoardOptim.from_chess960_pos(rng.randint(0, 959))
+        for _ in range(rng.randint(0, 60)):
+            moves = list(board.generate_legal_moves())
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        boards.append(board)
+    return boards
+
+
+def _move_records(boards, rng):
+    store = MoveRecordStore()
+    for board in boards:
+        moves = list(board.generate_legal_moves())
+        if not moves:
+            continue
+        player = NNPLayer("bench", board.turn, None)
+        player.board = board
+        moverec = player._get_moverec(rng.choice(moves), rng.random(), 0)
+        store.append(moverec)
+    return store
+
+
+def _net():
+    from chessnn import nn
+
+    nn._import_tf()
+    set_seed = getattr(nn.tf.random, "set_seed", None) or nn.tf.random.set_random_seed
+    set_seed(SEED)
+    return nn.NNChess(None, cache_bytes=0)
+
+
+def bench_board(results, rng):
+    boards = _random_boards(256, rng)
+
+    def run(method):
+        return lambda: [method(board, board.turn == BLACK) for board in boards]
+
+    results["board.get_position"] = _timeit(run(BoardOptim.get_position), len(boards))
+    results["board.get_attacked_defended"] = _timeit(run(BoardOptim.get_attacked_defended), len(boards))
+    results["board.get_possible_moves"] = _timeit(run(BoardOptim.get_possible_moves), len(boards))
+
+
+def bench_scores_to_move(results, rng):
+    players = []
+    for board in _random_boards(256, rng):
+        player = NNPLayer("bench", board.turn, None)
+        player.board = board
+        players.append((player, np.random.RandomState(rng.randint(0, 2 ** 31)).rand(len(MOVES_MAP))))
+    results["player._scores_to_move"] = _timeit(lambda: [x._scores_to_move(scores) for x, scores in players],
+                                                len(players))
+
+
+def bench_training_set(results, rng, net):
+    store = _move_records(_random_boards(max(TRAINING_SET_SIZES), rng), rng)
+    for size in TRAINING_SET_SIZES:
+        data = MoveRecordStore.from_records(store.to_records(0, size))
+
+        def run():
+            net._training_set_cache = None
+            net._data_to_training_set(data, False)
+
+        results["nn._data_to_training_set[%d]" % size] = _timeit(run, size)
+
+
+def bench_inference(results, rng, net):
+    store = _move_records(_random_boards(max(BATCH_SIZES), rng), rng)
+    for size in BATCH_SIZES:
+        records = [store[idx] for idx in range(size)]
+        results["nn.inference_batch[%d]" % size] = _timeit(lambda: net.inference_batch(records), size)
+
+
+def bench_games(results, rng, net):
+    from training import play_one_game
+
+    plies = 0
+    with tempfile.TemporaryDirectory() as path:
+        # not the default archive, it would write games and last.pgn into the working tree
+        archive = GameArchive(path)
+        started = time.perf_counter()
+        try:
+            for rnd in GAME_SEEDS:
+                pwhite = NNPLayer("Lisa", WHITE, net)
+                pblack = NNPLayer("Karen", BLACK, net)
+                play_one_game(pwhite, pblack, rnd, archive)
+                plies += len(pwhite.board.move_stack)
+            elapsed = time.perf_counter() - started
+        finally:
+            archive.close()
+    results["training.play_one_game"] = {"per_call": elapsed / len(GAME_SEEDS), "per_item": elapsed / plies,
+                                         "runs": len(GAME_SEEDS), "plies_per_sec": plies / elapsed,
+                                         "games_per_sec": len(GAME_SEEDS) / elapsed}
+
+
+BENCHMARKS = {
+    "board": (bench_board, False),
+    "scores_to_move": (bench_scores_to_move, False),
+    "training_set": (bench_training_set, True),
+    "inference": (bench_inference, True),
+    "games": (bench_games, True),
+}
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: list of (name, baseline seconds, current seconds) for per-item regressions beyond threshold
+    """
+    res = []
+    for name, value in sorted(results.items()):
+        if name in baseline and value["per_item"] > baseline[name]["per_item"] * (1 + threshold):
+            res.append((name, baseline[name]["per_item"], value["per_item"]))
+    return res
+
+
+def _git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.decode('ascii').strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--out", help="JSON file for results")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown ratio, 0.1 is 10%%")
+    parser.add_argument("--only", help="comma-separated benchmark groups: %s" % ",".join(BENCHMARKS))
+    args = parser.parse_args()
+
+    groups = args.only.split(",") if args.only else list(BENCHMARKS)
+    random.seed(SEED)
+    np.random.seed(SEED)
+    net = _net() if any(BENCHMARKS[group][1] for group in groups) else None
+
+    results = {}
+    for group in groups:
+        func, needs_net = BENCHMARKS[group]
+        logging.info("Running %s benchmarks", group)
+        rng = random.Random(SEED)
+        if needs_net:
+            func(results, rng, net)
+        else:
+            func(results, rng)
+
+    for name, value in sorted(results.items()):
+        logging.info("%-36s %10.3f ms/call %10.4f ms/item", name, value["per_call"] * 1000, value["per_item"] * 1000)
+
+    if args.out:
+        meta = {"revision": _git_revision(), "time": time.time(), "python": platform.python_version(),
+                "numpy": np.__version__, "machine": platform.machine()}
+        with open(args.out, "w") as fp:
+            json.dump({"meta": meta, "results": results}, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            logging.warning("Regression in %s: %.4f ms -> %.4f ms per item (%+.0f%%)", name, before * 1000,
+                            after * 1000, (after / before - 1) * 100)
+        if regressions:
+            sys.exit(1)
+        logging.info("No regressions beyond %.0f%%", args.threshold * 100)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,108 @@
+"""
+Plays uci.py against itself under a clock, driving it the way cutechess-cli does (ucinewgame, position, go with
+both clocks and increments), and reports move response latency, clock usage and time losses as JSON.
+
+Usage: python benchmarks/uci_latency.py [--games 2] [--tc 10+0.1] [--movetime MS] [-- engine args...]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+import chess
+from chess.engine import SimpleEngine, Limit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)] if values else 0.0
+
+
+def play_game(engine, base, increment, movetime=None, max_plies=200):
+    """
+    :return: list of (elapsed, limit) per move, where limit is the allowed time, and whether a flag fell
+    """
+    board = chess.Board()
+    clocks = {chess.WHITE: base, chess.BLACK: base}
+    moves = []
+    engine.protocol.send_line("ucinewgame")  # same as cutechess before every game
+    while not board.is_game_over(claim_draw=True) and board.ply() < max_plies:
+        if movetime:
+            limit = Limit(time=movetime)
+        else:
+            limit = Limit(white_clock=clocks[chess.WHITE], black_clock=clocks[chess.BLACK], white_inc=increment,
+                          black_inc=increment)
+        started = time.perf_counter()
+        result = engine.play(board, limit)
+        elapsed = time.perf_counter() - started
+
+        allowed = movetime if movetime else clocks[board.turn]
+        moves.append((elapsed, allowed))
+        if not movetime:
+            clocks[board.turn] -= elapsed
+            if clocks[board.turn] < 0:
+                logging.warning("%s lost on time at ply %d", chess.COLOR_NAMES[board.turn], board.ply())
+                return moves, True
+            clocks[board.turn] += increment
+        board.push(result.move)
+
+    logging.info("Game over: %s in %d plies", board.result(claim_draw=True), board.ply())
+    return moves, False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--games", type=int, default=2)
+    parser.add_argument("--tc", default="10+0.1", help="base seconds + increment seconds")
+    parser.add_argument("--movetime", type=int, help="fixed time per move in ms, instead of the clock")
+    parser.add_argument("--max-plies", type=int, default=200)
+    parser.add_argument("engine_args", nargs="*", help="extra arguments to uci.py")
+    args = parser.parse_args()
+
+    base, _, increment = args.tc.partition("+")
+    movetime = args.movetime / 1000 if args.movetime else None
+
+    started = time.perf_counter()
+    engine = SimpleEngine.popen_uci([sys.executable, os.path.join(ROOT, "uci.py")] + args.engine_args, cwd=ROOT)
+    try:
+        startup = time.perf_counter() - started
+        pings = []
+        for _ in range(10):
+            ping_started = time.perf_counter()
+            engine.ping()
+            pings.append(time.perf_counter() - ping_started)
+
+        moves, losses = [], 0
+        for _ in range(args.games):
+            game_moves, lost = play_game(engine, float(base), float(increment or 0), movetime, args.max_plies)
+            moves.extend(game_moves)
+            losses += lost
+    finally:
+        engine.quit()
+
+    latencies = [elapsed for elapsed, _ in moves]
+    overshoot = [elapsed - allowed for elapsed, allowed in moves if movetime]
+    results = {
+        "startup": startup,
+        "ping_p50": statistics.median(pings),
+        "moves": len(moves),
+        "latency_p50": _percentile(latencies, 50),
+        "latency_p90": _percentile(latencies, 90),
+        "latency_max": max(latencies, default=0.0),
+        "clock_share_p50": _percentile([elapsed / allowed for elapsed, allowed in moves], 50),
+        "time_losses": losses,
+    }
+    if movetime:
+        results["overshoot_max"] = max(overshoot, default=0.0)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,14 +1,15 @@
-import collections
 import copy
 import json
 import logging
+import random
 import sys
 from collections import Counter
 
 import chess
 import numpy as np
-from chess import pgn, SquareSet, SQUARES
-from matplotlib import pyplot
+from chess import pgn, SQUARES
+
+from chessnn.metrics import timed
 
 mpl_logger = logging.getLogger('matplotlib')
 mpl_logger.setLevel(logging.WARNING)
@@ -23,10 +24,33 @@ PIECE_VALUES = {
 }
 
 
+def pgn_comment(moverec):
+    return "ign" if moverec.ignore else "%.2f" % moverec.get_eval()
+
+
+def snapshot_to_pgn(snapshot):
+    """
+    :param snapshot: result of BoardOptim.pgn_snapshot()
+    :rtype: str
+    """
+    fen, chess960, moves, comments, headers = snapshot
+    board = chess.Board(fen, chess960=chess960)
+    for move in moves:
+        board.push(move)
+
+    journal = pgn.Game.from_board(board)
+    journal.headers.clear()
+    journal.headers.update(headers)
+    return journal.accept(MyStringExporter(comments))
+
+
 class MyStringExporter(pgn.StringExporter):
     comm_stack: list
 
     def __init__(self, comments: list):
+        """
+        :param comments: move comments as made by pgn_comment()
+        """
         super().__init__(headers=True, variations=True, comments=True)
         self.comm_stack = copy.copy(comments)
 
@@ -40,13 +64,7 @@ class MyStringExporter(pgn.StringExporter):
 
             # Write the SAN.
             if self.comm_stack:
-                log_rec = self.comm_stack.pop(0)
-                if log_rec.ignore:
-                    comm = "ign"
-                else:
-                    pass
-                    comm = "%.2f" % (log_rec.get_eval())
-
+                comm = self.comm_stack.pop(0)
                 self.write_token(board.san(move) + " {%s} " % comm)
             else:
                 self.write_token(board.san(move))
@@ -57,7 +75,6 @@ class MyStringExporter(pgn.StringExporter):
 class BoardOptim(chess.Board):
     def __init__(self, fen=chess.STARTING_FEN, *, chess960=False):
         super().__init__(fen, chess960=chess960)
-        self._fens = []
         self.comment_stack = []
         self.initial_fen = chess.STARTING_FEN
 
@@ -65,22 +82,29 @@ class BoardOptim(chess.Board):
         super().set_chess960_pos(sharnagl)
         self.initial_fen = self.fen()
 
+    @timed("pgn")
     def write_pgn(self, wp, bp, fname, roundd):
-        journal = pgn.Game.from_board(self)
-        journal.headers.clear()
-        if self.chess960:
-            journal.headers["Variant"] = "Chess960"
-        journal.headers["FEN"] = self.initial_fen
-        journal.headers["White"] = wp.name
-        journal.headers["Black"] = bp.name
-        journal.headers["Round"] = roundd
-        journal.headers["Result"] = self.result(claim_draw=True)
-        journal.headers["Site"] = self.explain()
-        exporter = MyStringExporter(self.comment_stack)
-        pgns = journal.accept(exporter)
+        pgns = snapshot_to_pgn(self.pgn_snapshot(wp.name, bp.name, roundd))
         with open(fname, "w") as out:
             out.write(pgns)
 
+    def pgn_snapshot(self, white, black, roundd):
+        """
+        Takes what snapshot_to_pgn() needs, the snapshot does not change with the board and can be exported in
+        another thread
+        """
+        headers = {}
+        if self.chess960:
+            headers["Variant"] = "Chess960"
+        headers["FEN"] = self.initial_fen
+        headers["White"] = white
+        headers["Black"] = black
+        headers["Round"] = roundd
+        headers["Result"] = self.result(claim_draw=True)
+        headers["Site"] = self.explain()
+        comments = [pgn_comment(x) for x in self.comment_stack]
+        return self.initial_fen, self.chess960, list(self.move_stack), comments, headers
+
     def explain(self):
         if self.is_checkmate():
             comm = "checkmate"
@@ -96,95 +120,138 @@ class BoardOptim(chess.Board):
             comm = "by other reason"
         return comm
 
+    def clear_stack(self):
+        super().clear_stack()
+        self._reset_zobrist()
+
+    def copy(self, *, stack=True):
+        board = super().copy(stack=stack)
+        if stack:
+            board._zobrist = self._zobrist[-len(board.move_stack) - 1:]
+            board._rebuild_repetitions()
+        else:
+            board._reset_zobrist()
+        return board
+
+    def apply_transform(self, f):
+        super().apply_transform(f)
+        self._reset_zobrist()
+
+    def apply_mirror(self):
+        super().apply_mirror()
+        self._reset_zobrist()
+
+    def _reset_zobrist(self):
+        castling = self.clean_castling_rights()
+        ep_square = self.ep_square if self.has_legal_en_passant() else None
+        key = _zobrist_pieces(self._zobrist_boards(), self.occupied) ^ _zobrist_state(self.turn, castling, ep_square)
+        # one (key, hashed castling rights, hashed ep square, irreversible) entry per position in the stack
+        self._zobrist = [(key, castling, ep_square, False)]
+        self._rebuild_repetitions()
+
+    def _rebuild_repetitions(self):
+        self._repetitions_saved = []
+        self._repetitions = Counter()
+        for idx, (key, _, _, irreversible) in enumerate(self._zobrist):
+            if irreversible and idx:
+                self._repetitions_saved.append(self._repetitions)
+                self._repetitions = Counter()
+            self._repetitions[key] += 1
+
+    def _zobrist_boards(self):
+        return (self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings,
+                self.occupied_co[chess.WHITE])
+
+    def zobrist_key(self):
+        return self._zobrist[-1][0]
+
+    def repetition_count(self):
+        """
+        How many times the current position occurred since the last irreversible move, O(1)
+        """
+        return self._repetitions[self._zobrist[-1][0]]
+
     def can_claim_threefold_repetition1(self):
-        # repetition = super().can_claim_threefold_repetition()
-        # if repetition:
-        cnt = Counter(self._fens)
-        return cnt[self._fens[-1]] >= 3
+        return self.repetition_count() >= 3
 
     def can_claim_threefold_repetition2(self):
         """
         Draw by threefold repetition can be claimed if the position on the
         board occured for the third time or if such a repetition is reached
         with one of the possible legal moves.
-
-        Note that checking this can be slow: In the worst case
-        scenario every legal move has to be tested and the entire game has to
-        be replayed because there is no incremental transposition table.
         """
-        transposition_key = self._transposition_key()
-        transpositions = collections.Counter()
-        transpositions.update((transposition_key,))
-
-        # Count positions.
-        switchyard = []
-        while self.move_stack:
-            move = self.pop()
-            switchyard.append(move)
+        if self.can_claim_threefold_repetition1():
+            return True
 
-            if self.is_irreversible(move):
-                break
+        for move in self.generate_legal_moves():
+            self.push(move)
+            try:
+                if self.repetition_count() >= 3:
+                    return True
+            finally:
+                self.pop()
 
-            transpositions.update((self._transposition_key(),))
+        return False
 
-        while switchyard:
-            self.push(switchyard.pop())
+    def can_claim_threefold_repetition(self):
+        return self.can_claim_threefold_repetition2()
 
-        # Threefold repetition occured.
-        if transpositions[transposition_key] >= 3:
-            return True
+    def is_fivefold_repetition1(self):
+        return self.repetition_count() >= 5
 
-        return False
+    def is_fivefold_repetition(self):
+        return self.is_fivefold_repetition1()
 
-    def is_fivefold_repetition1(self):
-        cnt = Counter(self._fens)
-        return cnt[self._fens[-1]] >= 5
+    def is_repetition(self, count=3):
+        return self.repetition_count() >= count
 
     def can_claim_draw1(self):
         return super().can_claim_draw() or self.fullmove_number > 100
 
     def push(self, move):
+        irreversible = self.is_irreversible(move)
+        before = self._zobrist_boards()
+        occupied = self.occupied
         super().push(move)
-        self._fens.append(self.epd().replace(" w ", " . ").replace(" b ", " . "))
 
-    def pop(self):
-        self._fens.pop(-1)
-        return super().pop()
+        key, castling, ep_square, _ = self._zobrist[-1]
+        after = self._zobrist_boards()
+        changed = occupied ^ self.occupied
+        for old, new in zip(before, after):
+            changed |= old ^ new
+        key ^= _zobrist_pieces(before, changed & occupied) ^ _zobrist_pieces(after, changed & self.occupied)
 
-    def get_position(self):
-        pos = np.full((8, 8, len(chess.PIECE_TYPES) * 2), 0)
-        for square in chess.SQUARES:
-            piece = self.piece_at(square)
+        new_castling = self.clean_castling_rights()
+        new_ep_square = self.ep_square if self.has_legal_en_passant() else None
+        # swap old castling/ep contributions for the new ones and toggle the side to move
+        key ^= _zobrist_state(chess.WHITE, castling, ep_square) ^ _zobrist_state(chess.BLACK, new_castling, new_ep_square)
 
-            if not piece:
-                continue
+        self._zobrist.append((key, new_castling, new_ep_square, irreversible))
+        if irreversible:
+            self._repetitions_saved.append(self._repetitions)
+            self._repetitions = Counter()
+        self._repetitions[key] += 1
 
-            int(piece.color)
-            channel = piece.piece_type - 1
-            if piece.color:
-                channel += len(PIECE_VALUES)
-            pos[chess.square_file(square)][chess.square_rank(square)][channel] = 1
+    def pop(self):
+        move = super().pop()
+        key, _, _, irreversible = self._zobrist.pop()
+        if irreversible:
+            self._repetitions = self._repetitions_saved.pop()
+        else:
+            self._repetitions[key] -= 1
+        return move
 
+    def get_position(self, flip=False):
+        """
+        :param flip: encode as if the board was mirrored, the same as ``self.mirror().get_position()``
+        """
+        pos = encode_positions([self], flips=[flip])[0]
         pos.flags.writeable = False
-
         return pos
 
-    def get_attacked_defended(self):
-        attacked = np.full(64, 0.0)
-        defended = np.full(64, 0.0)
-
-        our = self.occupied_co[self.turn]
-        their = self.occupied_co[not self.turn]
-
-        for square in SquareSet(our):
-            for our_defended in SquareSet(self.attacks_mask(square)):
-                defended[our_defended] = 1.0
-
-        for square in SquareSet(their):
-            for our_attacked in SquareSet(self.attacks_mask(square)):
-                attacked[our_attacked] = 1.0
-
-        return attacked, defended
+    def get_attacked_defended(self, flip=False):
+        attacked, defended = encode_attacked_defended([self], flips=[flip])
+        return attacked[0], defended[0]
 
     def _plot(self, matrix, position, fig, caption):
         """
@@ -224,6 +291,7 @@ class BoardOptim(chess.Board):
             return
         pos = self.get_position()
 
+        from matplotlib import pyplot  # heavy and only needed for debug plots
         pyplot.close("all")
         # fig = pyplot.figure()
         fig, axes = pyplot.subplots(3, 2, figsize=(5, 10), gridspec_kw={'wspace': 0.01, 'hspace': 0.3})
@@ -239,10 +307,12 @@ class BoardOptim(chess.Board):
         pyplot.show()
         logging.debug("drawn")
 
-    def get_possible_moves(self):
-        res = np.full(len(MOVES_MAP), 0.0)
-        for move in self.generate_legal_moves():
-            res[MOVES_MAP.index((move.from_square, move.to_square))] = 1.0
+    def get_possible_moves(self, flip=False):
+        res = np.zeros(len(MOVES_MAP), dtype=np.float32)
+        squares = [(move.from_square, move.to_square) for move in self.generate_legal_moves()]
+        if squares:
+            indices = moves_to_indices(*zip(*squares))
+            res[MOVES_FLIP[indices] if flip else indices] = 1.0
         return res
 
 
@@ -283,13 +353,144 @@ class MoveRecord(object):
         if self.from_square == self.to_square:
             return -1  # null move
 
-        return MOVES_MAP.index((self.from_square, self.to_square))
+        return int(MOVES_INDEX[self.from_square, self.to_square])
+
+
+def _position_masks(board, flip=False):
+    # mirrored board has colors swapped
+    colors = (chess.WHITE, chess.BLACK) if flip else (chess.BLACK, chess.WHITE)
+    return [board.pieces_mask(piece_type, color) for color in colors for piece_type in chess.PIECE_TYPES]
+
+
+def _unpack_bitboards(masks):
+    """
+    Unpacks integer bitboards into arrays of 0/1 bytes, one byte per square in python-chess square order
+
+    :type masks: list
+    :return: numpy.array of shape ``np.shape(masks) + (64,)``
+    """
+    masks = np.asarray(masks, dtype='<u8')
+    bits = np.unpackbits(masks.view(np.uint8), axis=-1, bitorder='little')
+    return bits.reshape(masks.shape + (64,))
+
+
+def encode_positions(boards, out=None, flips=None):
+    """
+    Encodes boards into the 8x8x12 (file, rank, channel) representation used by :meth:`BoardOptim.get_position`,
+    unpacking all piece bitboards at once instead of probing square by square
+
+    :type boards: list[chess.Board]
+    :param out: optional preallocated float32 buffer of shape (N, 8, 8, 12) to fill
+    :param flips: optional list of booleans, which boards to encode mirrored, without copying them
+    :return: numpy.array of shape (N, 8, 8, 12)
+    """
+    if out is None:
+        out = np.empty((len(boards), 8, 8, len(chess.PIECE_TYPES) * 2), dtype=np.float32)
+
+    if not len(boards):
+        return out
+
+    flips = [False] * len(boards) if flips is None else flips
+    out[...] = _position_bits([_position_masks(board, flip) for board, flip in zip(boards, flips)], flips)
+    return out
+
+
+def _position_bits(masks, flips):
+    """
+    :param masks: list of _position_masks() results
+    :return: numpy.array of 0/1 bytes, shape (N, 8, 8, 12)
+    """
+    bits = _unpack_bitboards(masks).reshape((len(masks), -1, 8, 8))
+    if any(flips):
+        flipped = np.flatnonzero(flips)
+        bits[flipped] = bits[flipped, :, ::-1]
+
+    # (N, channel, rank, file) -> (N, file, rank, channel)
+    return bits.transpose((0, 3, 2, 1))
+
+
+def _attacks_union(board, color):
+    mask = 0
+    for square in chess.scan_forward(board.occupied_co[color]):
+        mask |= board.attacks_mask(square)
+    return mask
+
+
+def encode_attacked_defended(boards, out=None, flips=None):
+    """
+    Builds the attacked and defended square maps for the side to move of every board, one OR-ed attack bitboard
+    per side, unpacked in a single step
+
+    :type boards: list[chess.Board]
+    :param out: optional preallocated float32 buffer of shape (2, N, 64) to fill
+    :param flips: optional list of booleans, which boards to encode mirrored, without copying them
+    :return: tuple of attacked and defended arrays, each of shape (N, 64)
+    """
+    if out is None:
+        out = np.empty((2, len(boards), 64), dtype=np.float32)
+
+    if len(boards):
+        out[...] = _attack_bits([[_attacks_union(board, not board.turn) for board in boards],
+                                 [_attacks_union(board, board.turn) for board in boards]], flips)
+
+    return out[0], out[1]
+
+
+def _attack_bits(masks, flips):
+    """
+    :param masks: attacked and defended bitboards, shape (2, N)
+    :return: numpy.array of 0/1 bytes, shape (2, N, 64)
+    """
+    bits = _unpack_bitboards(masks)
+    if flips is not None and any(flips):
+        flipped = np.flatnonzero(flips)
+        bits[:, flipped] = bits[:, flipped][:, :, SQUARES_FLIP]
+    return bits
 
 
 def is_debug():
     return 'pydevd' in sys.modules
 
 
+def _zobrist_table():
+    rnd = random.Random(0x5EED)
+    pieces = [[rnd.getrandbits(64) for _ in SQUARES] for _ in range(len(chess.PIECE_TYPES) * 2)]
+    castling = [rnd.getrandbits(64) for _ in SQUARES]
+    ep_squares = [rnd.getrandbits(64) for _ in SQUARES]
+    return pieces, castling, ep_squares, rnd.getrandbits(64)
+
+
+_ZOBRIST_PIECES, _ZOBRIST_CASTLING, _ZOBRIST_EP, _ZOBRIST_TURN = _zobrist_table()
+
+
+def _zobrist_pieces(boards, squares):
+    """
+    Zobrist contribution of the pieces standing on given squares
+
+    :param boards: piece type bitboards followed by the white pieces bitboard, as in BoardOptim._zobrist_boards
+    :param squares: bitboard of occupied squares to hash
+    """
+    key = 0
+    for square in chess.scan_forward(squares):
+        mask = chess.BB_SQUARES[square]
+        for channel, pieces in enumerate(boards[:-1]):
+            if pieces & mask:
+                if boards[-1] & mask:
+                    channel += len(chess.PIECE_TYPES)
+                key ^= _ZOBRIST_PIECES[channel][square]
+                break
+    return key
+
+
+def _zobrist_state(turn, castling, ep_square):
+    key = _ZOBRIST_TURN if turn else 0
+    for square in chess.scan_forward(castling):
+        key ^= _ZOBRIST_CASTLING[square]
+    if ep_square is not None:
+        key ^= _ZOBRIST_EP[ep_square]
+    return key
+
+
 def _possible_moves():
     res = set()
     for f in SQUARES:
@@ -311,3 +512,378 @@ def _possible_moves():
 
 
 MOVES_MAP = _possible_moves()
+
+
+# square index of the same square on vertically mirrored board
+SQUARES_FLIP = np.array([chess.square_mirror(square) for square in SQUARES], dtype=np.intp)
+SQUARES_FLIP.flags.writeable = False
+
+
+def _moves_index():
+    index = np.full((64, 64), -1, dtype=np.int16)
+    moves = np.array(MOVES_MAP, dtype=np.int16)
+    index[moves[:, 0], moves[:, 1]] = np.arange(len(MOVES_MAP))
+    flip = index[SQUARES_FLIP[moves[:, 0]], SQUARES_FLIP[moves[:, 1]]]
+    for arr in (index, moves, flip):
+        arr.flags.writeable = False
+    return index, moves[:, 0], moves[:, 1], flip
+
+
+MOVES_INDEX, MOVES_FROM, MOVES_TO, MOVES_FLIP = _moves_index()
+
+
+def moves_to_indices(from_squares, to_squares):
+    """
+    Vectorized lookup of MOVES_MAP positions for pairs of squares, -1 where the pair is not a possible move
+
+    :return: numpy.array of int16
+    """
+    return MOVES_INDEX[np.asarray(from_squares, dtype=np.intp), np.asarray(to_squares, dtype=np.intp)]
+
+
+NULL_MOVE_NUM = 0xFFFF
+FLAG_IGNORE = 1
+FLAG_EVAL = 2
+
+MOVE_RECORD_DTYPE = np.dtype([
+    ('position', np.uint8, (8 * 8 * len(chess.PIECE_TYPES) * 2 // 8,)),
+    ('possible', np.uint8, ((len(MOVES_MAP) + 7) // 8,)),
+    ('attacked', np.uint8, (64 // 8,)),
+    ('defended', np.uint8, (64 // 8,)),
+    ('move', np.uint16),
+    ('eval', np.float32),
+    ('flags', np.uint8),
+    ('piece', np.uint8),
+    ('full_move', np.uint16),
+    ('fifty_progress', np.uint8),
+    ('from_round', np.int32),
+])
+
+_POSITION_SHAPE = (8, 8, len(chess.PIECE_TYPES) * 2)
+
+
+def _unpack_column(packed, shape):
+    count = int(np.prod(shape))
+    bits = np.unpackbits(packed, axis=-1, count=count)
+    return bits.reshape(packed.shape[:-1] + shape).astype(np.float32)
+
+
+class MoveRecordStore(object):
+    """
+    Columnar, growable storage of move records, one preallocated array per MOVE_RECORD_DTYPE field.
+    Positions, legal move masks and square maps are kept bit-packed, so a record takes ~350 bytes.
+    """
+
+    def __init__(self, capacity=1024) -> None:
+        super().__init__()
+        self._size = 0
+        self._columns = {}
+        self.version = 0  # bumped on every write, lets consumers cache data derived from the store
+        self._allocate(max(capacity, 1))
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Wraps structured MOVE_RECORD_DTYPE array (possibly memory-mapped) as a store without copying it
+        """
+        store = cls(1)
+        store._columns = {name: records[name] for name in MOVE_RECORD_DTYPE.names}
+        store._size = len(records)
+        return store
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for idx in range(self._size):
+            yield MoveRecordView(self, idx)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._size
+        if not 0 <= idx < self._size:
+            raise IndexError("Move record index out of range: %s" % idx)
+        return MoveRecordView(self, idx)
+
+    @property
+    def capacity(self):
+        return len(self._columns['move'])
+
+    def column(self, name):
+        return self._columns[name][:self._size]
+
+    def _allocate(self, capacity):
+        columns = {}
+        for name in MOVE_RECORD_DTYPE.names:
+            field = MOVE_RECORD_DTYPE[name]
+            columns[name] = np.zeros((capacity,) + field.shape, dtype=field.base)
+            if name in self._columns:
+                columns[name][:self._size] = self._columns[name][:self._size]
+        self._columns = columns
+
+    def _reserve(self, size):
+        if size > self.capacity:
+            self._allocate(max(size, self.capacity * 2))
+
+    def append(self, moverec):
+        self._reserve(self._size + 1)
+        self._size += 1
+        self.put(self._size - 1, moverec)
+        return self._size - 1
+
+    def extend(self, moverecs):
+        for moverec in moverecs:
+            self.append(moverec)
+
+    def put(self, idx, moverec):
+        """
+        Overwrites record at given index with the contents of MoveRecord or MoveRecordView
+        """
+        self.version += 1
+        cols = self._columns
+        if isinstance(moverec, MoveRecordView):
+            for name in MOVE_RECORD_DTYPE.names:
+                cols[name][idx] = moverec._store._columns[name][moverec._idx]
+            return
+
+        for name in ('position', 'possible', 'attacked', 'defended'):
+            value = getattr(moverec, name)
+            if value is None:
+                cols[name][idx] = 0
+            else:
+                cols[name][idx] = np.packbits(np.asarray(value, dtype=bool).reshape(-1))
+
+        move_num = moverec.get_move_num()
+        cols['move'][idx] = NULL_MOVE_NUM if move_num < 0 else move_num
+        cols['eval'][idx] = moverec.get_eval()
+        cols['flags'][idx] = (FLAG_IGNORE if moverec.ignore else 0) | (FLAG_EVAL if moverec.eval is not None else 0)
+        cols['piece'][idx] = moverec.piece or 0
+        cols['full_move'][idx] = moverec.full_move
+        cols['fifty_progress'][idx] = moverec.fifty_progress
+        cols['from_round'][idx] = moverec.from_round
+
+    def to_records(self, start=0, stop=None):
+        """
+        :return: structured array of MOVE_RECORD_DTYPE, suitable for writing to disk
+        """
+        stop = self._size if stop is None else min(stop, self._size)
+        res = np.empty(max(stop - start, 0), dtype=MOVE_RECORD_DTYPE)
+        for name in MOVE_RECORD_DTYPE.names:
+            res[name] = self._columns[name][start:stop]
+        return res
+
+    def extend_records(self, records):
+        """
+        Bulk append of structured MOVE_RECORD_DTYPE array
+        """
+        self._reserve(self._size + len(records))
+        for name in MOVE_RECORD_DTYPE.names:
+            self._columns[name][self._size:self._size + len(records)] = records[name]
+        self._size += len(records)
+        self.version += 1
+
+    def get_positions(self, idx=slice(None)):
+        return _unpack_column(self.column('position')[idx], _POSITION_SHAPE)
+
+    def get_possible(self, idx=slice(None)):
+        return _unpack_column(self.column('possible')[idx], (len(MOVES_MAP),))
+
+    def get_attacked(self, idx=slice(None)):
+        return _unpack_column(self.column('attacked')[idx], (64,))
+
+    def get_defended(self, idx=slice(None)):
+        return _unpack_column(self.column('defended')[idx], (64,))
+
+
+class MoveRecordView(object):
+    """
+    Lightweight MoveRecord look-alike pointing into a row of MoveRecordStore
+    """
+    __slots__ = ('_store', '_idx')
+
+    def __init__(self, store, idx) -> None:
+        super().__init__()
+        self._store = store
+        self._idx = idx
+
+    def __str__(self) -> str:
+        return json.dumps({"move": self.get_move_num(), "eval": self.eval, "ignore": self.ignore,
+                           "full_move": self.full_move, "fifty_progress": self.fifty_progress,
+                           "from_round": self.from_round, "piece": self.piece})
+
+    def _get(self, name):
+        return self._store._columns[name][self._idx]
+
+    def _set(self, name, value):
+        self._store.version += 1
+        self._store._columns[name][self._idx] = value
+
+    @property
+    def position(self):
+        return _unpack_column(self._get('position'), _POSITION_SHAPE)
+
+    @property
+    def possible(self):
+        return _unpack_column(self._get('possible'), (len(MOVES_MAP),))
+
+    @property
+    def attacked(self):
+        return _unpack_column(self._get('attacked'), (64,))
+
+    @property
+    def defended(self):
+        return _unpack_column(self._get('defended'), (64,))
+
+    @property
+    def eval(self):
+        if self._get('flags') & FLAG_EVAL:
+            return float(self._get('eval'))
+        return None
+
+    @eval.setter
+    def eval(self, value):
+        if value is None:
+            self._set('flags', self._get('flags') & ~FLAG_EVAL)
+            self._set('eval', 0.0)
+        else:
+            self._set('flags', self._get('flags') | FLAG_EVAL)
+            self._set('eval', value)
+
+    @property
+    def ignore(self):
+        return bool(self._get('flags') & FLAG_IGNORE)
+
+    @ignore.setter
+    def ignore(self, value):
+        if value:
+            self._set('flags', self._get('flags') | FLAG_IGNORE)
+        else:
+            self._set('flags', self._get('flags') & ~FLAG_IGNORE)
+
+    @property
+    def piece(self):
+        return int(self._get('piece')) or None
+
+    @property
+    def full_move(self):
+        return int(self._get('full_move'))
+
+    @property
+    def fifty_progress(self):
+        return int(self._get('fifty_progress'))
+
+    @property
+    def from_round(self):
+        return int(self._get('from_round'))
+
+    @from_round.setter
+    def from_round(self, value):
+        self._set('from_round', value)
+
+    @property
+    def from_square(self):
+        move_num = self.get_move_num()
+        return 0 if move_num < 0 else int(MOVES_FROM[move_num])
+
+    @property
+    def to_square(self):
+        move_num = self.get_move_num()
+        return 0 if move_num < 0 else int(MOVES_TO[move_num])
+
+    def get_eval(self):
+        return float(self._get('eval'))
+
+    def get_move_num(self):
+        move_num = int(self._get('move'))
+        return -1 if move_num == NULL_MOVE_NUM else move_num
+
+
+def _record_columns(data, names):
+    """
+    Collects decoded columns for a batch given as MoveRecordStore, or as a sequence of MoveRecord/MoveRecordView.
+    Views are decoded in bulk per store they point into, so views mixed from several stores stay vectorized.
+    """
+    if isinstance(data, MoveRecordStore):
+        return _store_columns(data, slice(None), names)
+
+    if not len(data) or not all(isinstance(x, MoveRecordView) for x in data):
+        return _plain_columns(data, names)
+
+    groups = {}  # store -> (positions in data, indices in store)
+    for pos, moverec in enumerate(data):
+        group = groups.get(moverec._store)
+        if group is None:
+            group = groups[moverec._store] = ([], [])
+        group[0].append(pos)
+        group[1].append(moverec._idx)
+
+    if len(groups) == 1:
+        store, (_, idx) = next(iter(groups.items()))
+        return _store_columns(store, np.array(idx, dtype=np.intp), names)
+
+    res = {}
+    for store, (positions, idx) in groups.items():
+        for name, column in _store_columns(store, np.array(idx, dtype=np.intp), names).items():
+            if name not in res:
+                res[name] = np.empty((len(data),) + column.shape[1:], dtype=column.dtype)
+            res[name][positions] = column
+    return res
+
+
+def _store_columns(store, idx, names):
+    res = {}
+    for name in names:
+        if name == 'position':
+            res[name] = store.get_positions(idx)
+        elif name in ('possible', 'attacked', 'defended'):
+            res[name] = getattr(store, 'get_' + name)(idx)
+        elif name == 'move':
+            moves = store.column(name)[idx].astype(np.intp)
+            moves[moves == NULL_MOVE_NUM] = -1
+            res[name] = moves
+        else:
+            res[name] = store.column(name)[idx].astype(np.float32)
+    return res
+
+
+def _plain_columns(data, names):
+    res = {}
+    for name in names:
+        if name == 'move':
+            res[name] = np.fromiter((x.get_move_num() for x in data), dtype=np.intp, count=len(data))
+        elif name == 'eval':
+            res[name] = np.fromiter((x.get_eval() for x in data), dtype=np.float32, count=len(data))
+        elif name in ('full_move', 'fifty_progress'):
+            res[name] = np.fromiter((getattr(x, name) for x in data), dtype=np.float32, count=len(data))
+        else:
+            res[name] = np.array([getattr(x, name) for x in data], dtype=np.float32)
+    return res
+
+
+def records_to_inputs(data):
+    """
+    :return: [positions, flags] float32 NN inputs for a batch of move records
+    """
+    cols = _record_columns(data, ('position', 'full_move', 'fifty_progress'))
+    if not len(data):
+        cols['position'] = np.zeros((0,) + _POSITION_SHAPE, dtype=np.float32)
+
+    flags = np.empty((len(data), 3), dtype=np.float32)
+    flags[:, 0] = 1.0 / cols['full_move']
+    flags[:, 1] = 1.0 / (cols['fifty_progress'] + 1)
+    flags[:, 2] = cols['fifty_progress'] / 100.0
+    return [cols['position'], flags]
+
+
+def records_to_outputs(data):
+    """
+    :return: [moves, evals, possible, attacked, defended] float32 NN targets for a batch of move records
+    """
+    cols = _record_columns(data, ('eval', 'move', 'possible', 'attacked', 'defended'))
+    evals = cols['eval']
+
+    # uniform target over other moves for lost moves, the move itself carries the eval
+    moves = np.empty((len(data), len(MOVES_MAP)), dtype=np.float32)
+    moves[...] = np.where(evals, 0.0, 1.0 / (len(MOVES_MAP) - 1))[:, np.newaxis]
+    moves[np.arange(len(data)), cols['move']] = evals
+    return [moves, evals[:, np.newaxis], cols['possible'], cols['attacked'], cols['defended']]
@@ -0,0 +1,136 @@
+"""
+Append-only archive of played games. Games are exported to PGN by a background thread and appended to rotating
+gzip segments, one gzip member per game, so a segment is a valid .pgn.gz on its own and a game can be read back
+from its offset alone. A JSON-lines sidecar index per writer maps round numbers to (segment, offset, length).
+"""
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+
+from chessnn import snapshot_to_pgn
+from chessnn.metrics import timed
+from chessnn.shards import _replace_atomic
+
+INDEX_SUFFIX = ".index.jsonl"
+SEGMENT_SUFFIX = ".pgn.gz"
+
+
+class GameArchive(object):
+    """
+    :param path: archive directory
+    :param prefix: name of segments and index of this writer, different for concurrent writers
+    :param latest: file to keep rewriting with the latest game, like last.pgn for view.html
+    """
+
+    def __init__(self, path, prefix="games", segment_games=1000, latest=None, queue_size=1024) -> None:
+        super().__init__()
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.prefix = prefix
+        self.segment_games = segment_games
+        self.latest = latest
+        self._index = os.path.join(path, prefix + INDEX_SUFFIX)
+        # never append to a segment of an earlier run, it may end with a partial game
+        self._segment = max([_segment_number(x) for x in glob.glob(self._segment_name("*"))], default=-1) + 1
+        self._segment_count = 0
+        self._queue = queue.Queue(queue_size)
+        self._thr = threading.Thread(target=self._run, name="GameArchive", daemon=True)
+        self._thr.start()
+
+    def _segment_name(self, number):
+        return os.path.join(self.path, "%s-%s%s" % (self.prefix, number if number == "*" else "%06d" % number,
+                                                    SEGMENT_SUFFIX))
+
+    @timed("pgn")
+    def add(self, board, white, black, rnd, final=True):
+        """
+        Queues the game for writing, blocks only when the writer is queue_size games behind
+
+        :type board: chessnn.BoardOptim
+        :param final: False to only update the latest game file, for following an unfinished game
+        """
+        self._queue.put((board.pgn_snapshot(white, black, rnd), rnd, final))
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thr.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                self._write(*item)
+            except BaseException:
+                logging.exception("Failed to archive game")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, snapshot, rnd, final):
+        text = snapshot_to_pgn(snapshot)
+        if final:
+            self._append(text, rnd)
+
+        if self.latest:
+            try:
+                _replace_atomic(self.latest, lambda fhd: fhd.write(text.encode('utf-8')))
+            except OSError as exc:
+                logging.warning("Failed to update %s: %s", self.latest, exc)
+
+    def _append(self, text, rnd):
+        if self._segment_count >= self.segment_games:
+            self._segment += 1
+            self._segment_count = 0
+
+        fname = self._segment_name(self._segment)
+        data = gzip.compress((text + "\n\n").encode('utf-8'))
+        with open(fname, "ab") as fhd:
+            offset = fhd.seek(0, os.SEEK_END)
+            fhd.write(data)
+        self._segment_count += 1
+
+        entry = {"round": rnd, "segment": os.path.basename(fname), "offset": offset, "length": len(data)}
+        with open(self._index, "a") as fhd:
+            fhd.write(json.dumps(entry) + "\n")
+
+
+def _segment_number(fname):
+    return int(os.path.basename(fname)[:-len(SEGMENT_SUFFIX)].rsplit("-", 1)[1])
+
+
+def read_index(path):
+    """
+    :return: dict of round number to index entry, from all writers of the archive; the latest game wins for a round
+    """
+    res = {}
+    for fname in sorted(glob.glob(os.path.join(path, "*" + INDEX_SUFFIX))):
+        with open(fname) as fhd:
+            for line in fhd:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning("Skipping broken index line in %s", fname)
+                    continue
+                res[entry["round"]] = entry
+    return res
+
+
+def read_game(path, rnd, index=None):
+    """
+    :return: PGN text of the game played in round, or None if it is not archived
+    """
+    entry = (index if index is not None else read_index(path)).get(rnd)
+    if entry is None:
+        return None
+
+    with open(os.path.join(path, entry["segment"]), "rb") as fhd:
+        fhd.seek(entry["offset"])
+        return gzip.decompress(fhd.read(entry["length"])).decode('utf-8')
@@ -0,0 +1,130 @@
+import collections
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class LatencyStats(object):
+    """
+    Keeps last samples per name, for percentiles
+    """
+
+    def __init__(self, size=1000) -> None:
+        super().__init__()
+        self._lock = threading.Lock()
+        self._samples = collections.defaultdict(lambda: collections.deque(maxlen=size))
+        self._counts = collections.Counter()
+
+    def add(self, name, value):
+        with self._lock:
+            self._samples[name].append(value)
+            self._counts[name] += 1
+
+    def summary(self):
+        with self._lock:
+            res = {}
+            for name, samples in self._samples.items():
+                values = np.array(samples)
+                res[name] = {"count": self._counts[name], "p50": float(np.percentile(values, 50)),
+                             "p99": float(np.percentile(values, 99)), "max": float(values.max())}
+            return res
+
+
+class InferenceBatcher(object):
+    """
+    Thread-safe front end of NN for many concurrent callers with small requests. Records are queued and sent to
+    net.inference_batch() together, once max_batch records are waiting or the oldest one waited for max_delay seconds.
+
+    Has the inference() and inference_batch() methods of NN, so it can be given to players instead of the net.
+    """
+
+    def __init__(self, net, max_batch=64, max_delay=0.005) -> None:
+        super().__init__()
+        self.net = net
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batch_sizes = collections.Counter()
+        self._latency = LatencyStats()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thr = threading.Thread(target=self._run, name="InferenceBatcher", daemon=True)
+        self._thr.start()
+
+    def submit(self, record):
+        """
+        :return: Future with the NN outputs for the record, same as an item of NN.inference_batch() result
+        """
+        if self._closed:
+            raise RuntimeError("Batcher is closed")
+        future = Future()
+        self._queue.put((record, future, time.time()))
+        return future
+
+    def inference(self, data):
+        return self.inference_batch(data)[0]
+
+    def inference_batch(self, data):
+        return [future.result() for future in [self.submit(record) for record in data]]
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thr.join()
+
+    def stats(self):
+        latency = self._latency.summary().get("latency", {})
+        return {
+            "queue_depth": self._queue.qsize(),
+            "batches": sum(self.batch_sizes.values()),
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "latency_p50": latency.get("p50", 0.0),
+            "latency_p99": latency.get("p99", 0.0),
+        }
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = item[2] + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # finish this batch first
+                    break
+                batch.append(item)
+
+            self._process(batch)
+
+        while not self._queue.empty():
+            item = self._queue.get()
+            if item:
+                item[1].set_exception(RuntimeError("Batcher is closed"))
+
+    def _process(self, batch):
+        self.batch_sizes[len(batch)] += 1
+        batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            predictions = self.net.inference_batch([record for record, _, _ in batch])
+        except BaseException as exc:
+            logging.exception("Inference failed for batch of %s", len(batch))
+            for _, future, _ in batch:
+                future.set_exception(exc)
+            return
+
+        now = time.time()
+        for (_, future, queued), prediction in zip(batch, predictions):
+            self._latency.add("latency", now - queued)
+            future.set_result(prediction)
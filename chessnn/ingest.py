@@ -0,0 +1,206 @@
+"""
+Bulk conversion of PGN databases into move records for training:
+
+    python -m chessnn.ingest games.pgn moves-dir [--workers 8] [--chunk-mb 1] [--round 0]
+
+The file is split into chunks at game boundaries, chunks are replayed on BoardOptim in a process pool, and every
+chunk is stored as one ShardedMoves shard. Records have the same fields as those from PlayerBase._get_moverec, with
+eval from the game result: 1 for moves of the winner, 0 for the loser, 0.5 for draws. Finished chunks are kept in
+the shards index, together with the records, so an interrupted run continues where it stopped.
+The PGN file has to be uncompressed, because chunks are read by byte offsets.
+"""
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import time
+
+import chess
+import chess.pgn
+import numpy as np
+
+from chessnn import BoardOptim, MOVE_RECORD_DTYPE, MOVES_MAP, MOVES_FLIP, SQUARES_FLIP, FLAG_EVAL, \
+    moves_to_indices, _position_masks, _position_bits, _attacks_union, _attack_bits
+from chessnn.shards import ShardedMoves
+
+RESULT_EVALS = {
+    "1-0": {chess.WHITE: 1.0, chess.BLACK: 0.0},
+    "0-1": {chess.WHITE: 0.0, chess.BLACK: 1.0},
+    "1/2-1/2": {chess.WHITE: 0.5, chess.BLACK: 0.5},
+}
+
+
+def split_pgn(fname, chunk_bytes):
+    """
+    :return: byte offsets of chunk starts, each at an "[Event " line, followed by the file size
+    """
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with open(fname, "rb") as fhd:
+        pos = chunk_bytes
+        while pos < size:
+            fhd.seek(pos)
+            fhd.readline()  # rest of a line cut in the middle
+            while True:
+                start = fhd.tell()
+                line = fhd.readline()
+                if not line or line.startswith(b"[Event "):
+                    break
+
+            if not line:
+                break
+            bounds.append(start)
+            pos = start + chunk_bytes
+    bounds.append(size)
+    return bounds
+
+
+class _RecordsBuilder(object):
+    """
+    Collects bitboards and move data of replayed positions, encoding is done for all of them at once
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.flips = []
+        self.positions = []
+        self.attacks = [[], []]
+        self.possible = []
+        self.moves = []
+        self.pieces = []
+        self.full_moves = []
+        self.fifty = []
+        self.evals = []
+
+    def add(self, board, move, geval):
+        """
+        Same record as PlayerBase._get_moverec() of the player to move
+        """
+        flip = board.turn == chess.BLACK
+        self.flips.append(flip)
+        self.positions.append(_position_masks(board, flip))
+        self.attacks[0].append(_attacks_union(board, not board.turn))
+        self.attacks[1].append(_attacks_union(board, board.turn))
+        self.possible.append([(x.from_square, x.to_square) for x in board.generate_legal_moves()])
+        self.moves.append((move.from_square, move.to_square))
+        self.pieces.append(board.piece_type_at(move.from_square) or 0)
+        self.full_moves.append(board.fullmove_number)
+        self.fifty.append(min(board.halfmove_clock, 255))
+        self.evals.append(geval)
+
+    def __len__(self):
+        return len(self.flips)
+
+    def to_records(self, from_round):
+        res = np.zeros(len(self), dtype=MOVE_RECORD_DTYPE)
+        if not len(self):
+            return res
+
+        flips = np.array(self.flips)
+        res['position'] = np.packbits(_position_bits(self.positions, flips).reshape((len(self), -1)), axis=1)
+        attacks = _attack_bits(self.attacks, flips)
+        res['attacked'] = np.packbits(attacks[0], axis=1)
+        res['defended'] = np.packbits(attacks[1], axis=1)
+
+        possible = np.zeros((len(self), len(MOVES_MAP)), dtype=bool)
+        rows = np.repeat(np.arange(len(self)), [len(x) for x in self.possible])
+        squares = np.array([x for moves in self.possible for x in moves], dtype=np.intp).reshape((-1, 2))
+        indices = moves_to_indices(squares[:, 0], squares[:, 1])
+        possible[rows, np.where(flips[rows], MOVES_FLIP[indices], indices)] = True
+        res['possible'] = np.packbits(possible, axis=1)
+
+        moves = np.array(self.moves, dtype=np.intp)
+        moves[flips] = SQUARES_FLIP[moves[flips]]
+        res['move'] = moves_to_indices(moves[:, 0], moves[:, 1])
+        res['eval'] = self.evals
+        res['flags'] = FLAG_EVAL
+        res['piece'] = self.pieces
+        res['full_move'] = self.full_moves
+        res['fifty_progress'] = self.fifty
+        res['from_round'] = from_round
+        return res
+
+
+def replay_games(text, builder):
+    """
+    Replays all decisive and drawn games of the PGN text into builder
+
+    :return: number of games used and skipped
+    """
+    used, skipped = 0, 0
+    handle = io.StringIO(text)
+    while True:
+        game = chess.pgn.read_game(handle)
+        if game is None:
+            break
+
+        evals = RESULT_EVALS.get(game.headers.get("Result"))
+        if evals is None or game.errors or game.headers.variant() is not chess.Board:
+            skipped += 1
+            continue
+
+        try:
+            board = BoardOptim(game.headers.get("FEN", chess.STARTING_FEN), chess960=game.headers.is_chess960())
+        except ValueError:
+            skipped += 1
+            continue
+
+        for move in game.mainline_moves():
+            builder.add(board, move, evals[board.turn])
+            board.push(move)
+        used += 1
+    return used, skipped
+
+
+def _ingest_chunk(task):
+    fname, start, stop, from_round = task
+    with open(fname, "rb") as fhd:
+        fhd.seek(start)
+        text = fhd.read(stop - start).decode("utf-8", errors="replace")
+
+    builder = _RecordsBuilder()
+    used, skipped = replay_games(text, builder)
+    return start, builder.to_records(from_round), used, skipped
+
+
+def ingest_pgn(fname, path, workers=None, chunk_bytes=2 ** 20, from_round=0):
+    """
+    Converts PGN file into move records in ShardedMoves at path, skipping chunks done by earlier runs
+
+    :return: number of records added
+    """
+    shards = ShardedMoves(path)
+    key = "ingested:%s:%d:%d" % (os.path.basename(fname), os.path.getsize(fname), chunk_bytes)
+    done = set(shards.get_meta(key, []))
+    bounds = split_pgn(fname, chunk_bytes)
+    tasks = [(fname, start, stop, from_round) for start, stop in zip(bounds, bounds[1:]) if start not in done]
+    logging.info("Ingesting %s: %d chunks, %d done before", fname, len(bounds) - 1, len(done))
+
+    started = time.time()
+    positions, games, skipped = 0, 0, 0
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers) as pool:
+        for num, (start, records, used, bad) in enumerate(pool.imap_unordered(_ingest_chunk, tasks), 1):
+            done.add(start)
+            shards.append(records, meta={key: sorted(done)})
+            positions += len(records)
+            games += used
+            skipped += bad
+            elapsed = time.time() - started
+            logging.info("Chunk %d/%d: %d games, %d positions, %.0f positions/s, %d games skipped", num, len(tasks),
+                         games, positions, positions / max(elapsed, 1e-3), skipped)
+    return positions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts PGN games into move records")
+    parser.add_argument("pgn")
+    parser.add_argument("path", help="ShardedMoves directory to add records to")
+    parser.add_argument("--workers", type=int, default=None, help="processes, defaults to CPU count")
+    parser.add_argument("--chunk-mb", type=float, default=1.0)
+    parser.add_argument("--round", type=int, default=0, help="from_round of the records")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    ingest_pgn(args.pgn, args.path, args.workers, int(args.chunk_mb * 2 ** 20), args.round)
@@ -0,0 +1,208 @@
+"""
+Engine labels for positions and stored move records, from a pool of UCI engine processes driven with the asyncio
+API of chess.engine:
+
+    python -m chessnn.labeler moves-dir labeled-dir [--engine stockfish] [--engines 4] [--nodes 2000]
+
+Records are relabeled with the engine's win expectation for the side to move, in place of the game result.
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import time
+
+import chess
+import chess.engine
+import numpy as np
+
+from chessnn import FLAG_EVAL, _POSITION_SHAPE, _unpack_column
+from chessnn.shards import ShardedMoves
+
+MATE_SCORE = 10000
+
+Label = collections.namedtuple("Label", ("eval", "cp", "mate", "move"))
+
+
+def _to_label(info):
+    """
+    :return: Label of analysis info, eval is the expected score of the side to move in 0..1
+    """
+    score = info["score"].relative
+    pv = info.get("pv")
+    return Label(score.wdl().expectation(), score.score(mate_score=MATE_SCORE), score.mate(), pv[0] if pv else None)
+
+
+class EngineLabeler(object):
+    """
+    Pool of engine processes analysing positions concurrently, one position per engine at a time.
+    Crashed or hanging engines are restarted and the position is retried.
+
+    Use as ``async with EngineLabeler(...) as labeler: labels = await labeler.label(boards)``.
+    """
+
+    def __init__(self, command="stockfish", engines=None, limit=None, options=None, timeout=10.0, retries=2) -> None:
+        """
+        :param command: engine executable, or list of executable and arguments
+        :param engines: pool size, defaults to CPU count
+        :param limit: default chess.engine.Limit per position
+        :param options: UCI options for every engine, like {"Threads": 1, "Hash": 16}
+        :param timeout: seconds on top of the time limit after which an engine is considered hanging
+        """
+        super().__init__()
+        self.command = command
+        self.size = engines or os.cpu_count()
+        self.limit = limit or chess.engine.Limit(time=0.01)
+        self.options = options or {}
+        self.timeout = timeout
+        self.retries = retries
+        self.positions = 0
+        self.failures = 0
+        self.restarts = 0
+        self._started = None
+        self._idle = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def start(self):
+        self._idle = asyncio.Queue()
+        for engine in await asyncio.gather(*[self._open() for _ in range(self.size)]):
+            self._idle.put_nowait(engine)
+        self._started = time.time()
+        logging.info("Started %s engines: %s", self.size, self.command)
+
+    async def close(self):
+        while not self._idle.empty():
+            await self._quit(self._idle.get_nowait())
+
+    async def _open(self):
+        _, engine = await chess.engine.popen_uci(self.command)
+        if self.options:
+            await engine.configure(self.options)
+        return engine
+
+    async def _quit(self, engine):
+        try:
+            await asyncio.wait_for(engine.quit(), 1.0)
+        except (asyncio.TimeoutError, chess.engine.EngineError, chess.engine.EngineTerminatedError):
+            pass
+
+    def positions_per_sec(self):
+        return self.positions / max(time.time() - self._started, 1e-3) if self._started else 0.0
+
+    async def analyse(self, board, limit=None):
+        """
+        :return: Label, or None if the engine failed on the position after all retries
+        """
+        limit = limit or self.limit
+        timeout = (limit.time or 0) + self.timeout
+        engine = await self._idle.get()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    info = await asyncio.wait_for(engine.analyse(board, limit), timeout)
+                    self.positions += 1
+                    return _to_label(info)
+                except (asyncio.TimeoutError, chess.engine.EngineTerminatedError) as exc:
+                    logging.warning("Engine failed on %s (attempt %d): %r, restarting", board.fen(), attempt + 1, exc)
+                    self.restarts += 1
+                    await self._quit(engine)
+                    engine = await self._open()
+                except chess.engine.EngineError as exc:
+                    # engine is alive but can't take this position, restarting won't help
+                    logging.warning("Engine rejected %s: %s", board.fen(), exc)
+                    break
+
+            self.failures += 1
+            return None
+        finally:
+            self._idle.put_nowait(engine)
+
+    async def label(self, boards, limits=None):
+        """
+        :param limits: optional list of chess.engine.Limit, one per board, None items use the default limit
+        :return: list of Label or None, one per board
+        """
+        limits = limits or [None] * len(boards)
+        return await asyncio.gather(*[self.analyse(board, limit) for board, limit in zip(boards, limits)])
+
+
+def label_boards(boards, command="stockfish", engines=None, limit=None, options=None):
+    """
+    Blocking shortcut for labeling one batch with a temporary pool
+    """
+
+    async def run():
+        async with EngineLabeler(command, engines, limit, options) as labeler:
+            return await labeler.label(boards)
+
+    return asyncio.run(run())
+
+
+def records_to_boards(records):
+    """
+    Rebuilds boards from the position column of MOVE_RECORD_DTYPE records. Positions are stored from the point
+    of view of the side to move, so boards have white to move; castling rights and en passant are not stored
+    and are left out.
+
+    :return: list of chess.Board, None for positions that are not valid boards
+    """
+    res = []
+    positions = _unpack_column(records["position"], _POSITION_SHAPE).astype(bool)
+    for position in positions:
+        board = chess.Board(None)
+        for file, rank, channel in zip(*np.nonzero(position)):
+            color = chess.WHITE if channel >= len(chess.PIECE_TYPES) else chess.BLACK
+            board.set_piece_at(chess.square(file, rank), chess.Piece(channel % len(chess.PIECE_TYPES) + 1, color))
+        res.append(board if board.is_valid() else None)
+    return res
+
+
+async def label_records(labeler, records, batch_size=1024):
+    """
+    :return: copy of records with engine evals, records without a label keep their eval
+    """
+    res = records.copy()
+    boards = records_to_boards(records)
+    for start in range(0, len(records), batch_size):
+        idx = [x for x in range(start, min(start + batch_size, len(records))) if boards[x] is not None]
+        for pos, label in zip(idx, await labeler.label([boards[x] for x in idx])):
+            if label is not None:
+                res["eval"][pos] = label.eval
+                res["flags"][pos] |= FLAG_EVAL
+        logging.info("Labeled %d/%d, %.0f positions/s, %d restarts, %d failed", min(start + batch_size, len(records)),
+                     len(records), labeler.positions_per_sec(), labeler.restarts, labeler.failures)
+    return res
+
+
+async def label_shards(src, dst, labeler, batch_size=1024):
+    """
+    Writes every shard of ShardedMoves at src, relabeled, as a shard of ShardedMoves at dst
+    """
+    target = ShardedMoves(dst)
+    async with labeler:
+        for records in ShardedMoves(src).iter_records():
+            target.append(await label_records(labeler, records, batch_size))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Labels stored move records with engine evals")
+    parser.add_argument("src", help="ShardedMoves directory to read")
+    parser.add_argument("dst", help="ShardedMoves directory to write")
+    parser.add_argument("--engine", default="stockfish")
+    parser.add_argument("--engines", type=int, default=None, help="engine processes, defaults to CPU count")
+    parser.add_argument("--nodes", type=int, default=None, help="nodes per position, instead of --time")
+    parser.add_argument("--time", type=float, default=0.01, help="seconds per position")
+    parser.add_argument("--batch", type=int, default=1024)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    limit = chess.engine.Limit(nodes=args.nodes) if args.nodes else chess.engine.Limit(time=args.time)
+    asyncio.run(label_shards(args.src, args.dst, EngineLabeler(args.engine, args.engines, limit, {"Threads": 1}),
+                             args.batch))
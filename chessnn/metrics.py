@@ -0,0 +1,173 @@
+"""
+Named timers and counters for the self-play and training loop. Disabled by default, when disabled a timed call
+costs one attribute check. Enable with metrics.enable(), or set CHESSNN_METRICS to a JSON-lines file name and call
+metrics.enable_from_env().
+
+Timings are aggregated per finished game (everything measured since the previous game finished) and per window
+of N games. Each game and each window is written as one JSON line, windows are also logged as a summary.
+"""
+import functools
+import json
+import logging
+import os
+import time
+from collections import Counter
+
+METRICS_ENV = "CHESSNN_METRICS"
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    __slots__ = ('_metrics', '_name', '_started')
+
+    def __init__(self, metrics, name) -> None:
+        super().__init__()
+        self._metrics = metrics
+        self._name = name
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._metrics.add_time(self._name, time.perf_counter() - self._started)
+        return False
+
+
+class Metrics(object):
+    def __init__(self) -> None:
+        super().__init__()
+        self.enabled = False
+        self.fname = None
+        self.every = 10
+        self._timers = {}  # name -> [calls, seconds] since last finished game
+        self._counters = Counter()
+        self._window_timers = {}
+        self._window_counters = Counter()
+        self._games = 0
+        self._window_games = 0
+        self._window_started = time.time()
+
+    def enable(self, fname=None, every=10):
+        """
+        :param fname: JSON-lines file to append metrics to, or None for log summaries only
+        :param every: number of games in a window
+        """
+        self.enabled = True
+        self.fname = fname
+        self.every = every
+        self._window_started = time.time()
+        logging.info("Metrics enabled, summary every %s games%s", every, (", file: %s" % fname) if fname else "")
+
+    def enable_from_env(self, suffix=None, every=10):
+        fname = os.environ.get(METRICS_ENV)
+        if not fname:
+            return
+        if suffix:
+            root, ext = os.path.splitext(fname)
+            fname = "%s.%s%s" % (root, suffix, ext)
+        self.enable(fname, every)
+
+    def disable(self):
+        self.enabled = False
+
+    def timer(self, name):
+        """
+        Context manager adding the time spent inside to the named timer
+        """
+        return _Timer(self, name) if self.enabled else _NULL_TIMER
+
+    def add_time(self, name, seconds):
+        entry = self._timers.get(name)
+        if entry is None:
+            entry = self._timers[name] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self._counters[name] += value
+
+    def game_finished(self, rnd, result, plies):
+        if not self.enabled:
+            return
+
+        self._games += 1
+        self._window_games += 1
+        self.count("plies", plies)
+        self._write({"type": "game", "time": time.time(), "game": self._games, "round": rnd, "result": result,
+                     "timers": self._timers, "counters": self._counters})
+
+        for name, (calls, seconds) in self._timers.items():
+            entry = self._window_timers.setdefault(name, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+        self._window_counters.update(self._counters)
+        self._timers = {}
+        self._counters = Counter()
+
+        if self._window_games >= self.every:
+            self.flush()
+
+    def flush(self):
+        """
+        Logs and writes the summary of the current window, then starts a new one
+        """
+        if not self.enabled or not self._window_games:
+            return
+
+        elapsed = time.time() - self._window_started
+        parts = []
+        for name, (calls, seconds) in sorted(self._window_timers.items(), key=lambda x: -x[1][1]):
+            parts.append("%s %.0f%% (%d x %.2fms)" % (name, 100 * seconds / elapsed, calls, 1000 * seconds / calls))
+        logging.info("Last %d games in %.1fs, %.1f plies/s: %s", self._window_games, elapsed,
+                     self._window_counters["plies"] / elapsed, ", ".join(parts))
+        self._write({"type": "window", "time": time.time(), "games": self._window_games, "elapsed": elapsed,
+                     "timers": self._window_timers, "counters": self._window_counters})
+
+        self._window_timers = {}
+        self._window_counters = Counter()
+        self._window_games = 0
+        self._window_started = time.time()
+
+    def _write(self, item):
+        if self.fname:
+            with open(self.fname, "a") as fhd:
+                fhd.write(json.dumps(item) + "\n")
+
+
+metrics = Metrics()
+
+
+def timed(name):
+    """
+    Decorator putting every call of the function into the named timer
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.add_time(name, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
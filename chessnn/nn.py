@@ -1,36 +1,109 @@
+import collections
+import json
 import logging
 import os
+import struct
 import time
 import warnings
 from abc import abstractmethod
 
-# from https://github.com/tensorflow/tensorflow/issues/26691
-# noinspection PyPackageRequirements
-from operator import itemgetter
-
-import absl.logging
-import chess
 import numpy as np
 from chess import PIECE_TYPES
 
-from chessnn import MoveRecord, MOVES_MAP
+from chessnn import MOVES_MAP, records_to_inputs, records_to_outputs, MoveRecordStore, is_debug
+from chessnn.metrics import timed
+
+# TensorFlow takes seconds to import, it is loaded on first NN construction by _import_tf()
+tf = models = layers = utils = callbacks = regularizers = None
+
+
+def _import_tf():
+    global tf, models, layers, utils, callbacks, regularizers
+    if tf is not None:
+        return
+
+    # from https://github.com/tensorflow/tensorflow/issues/26691
+    # noinspection PyPackageRequirements
+    import absl.logging
+    # noinspection PyProtectedMember
+    logging.root.removeHandler(absl.logging._absl_handler)
 
-# noinspection PyProtectedMember
-logging.root.removeHandler(absl.logging._absl_handler)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        import tensorflow
+        from tensorflow.python.keras import models, layers, utils, callbacks, regularizers
+    tf = tensorflow
 
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-with warnings.catch_warnings():
-    warnings.filterwarnings("ignore", category=FutureWarning)
-    from tensorflow.python.keras import models, layers, utils, callbacks, regularizers
+
+class InferenceCache(object):
+    """
+    LRU cache of per-record NN outputs, keyed by the encoded position and move clocks
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, max_entries=None) -> None:
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.size_bytes = 0
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def key(moverec):
+        pos = np.packbits(np.asarray(moverec.position, dtype=bool).reshape(-1)).tobytes()
+        return pos + struct.pack("<HH", moverec.full_move, moverec.fifty_progress)
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._items.move_to_end(key)
+        return value[1]
+
+    def put(self, key, outputs):
+        if not self.max_bytes:
+            return
+
+        outputs = [np.array(x) for x in outputs]  # don't keep whole batch alive through views
+        for arr in outputs:
+            arr.flags.writeable = False
+        size = len(key) + sum(x.nbytes for x in outputs)
+        if key in self._items:
+            self.size_bytes -= self._items.pop(key)[0]
+        self._items[key] = (size, outputs)
+        self.size_bytes += size
+
+        while self.size_bytes > self.max_bytes or (self.max_entries and len(self._items) > self.max_entries):
+            self.size_bytes -= self._items.popitem(last=False)[1][0]
+
+    def clear(self):
+        self._items.clear()
+        self.size_bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"entries": len(self._items), "bytes": self.size_bytes, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
 
 
 class NN(object):
-    _model: models.Model
+    _model: "models.Model"
 
-    def __init__(self, filename=None) -> None:
+    def __init__(self, filename=None, cache_bytes=64 * 2 ** 20) -> None:
         super().__init__()
+        _import_tf()
         self._train_acc_threshold = 0.9
         self._validate_acc_threshold = 0.9
+        self._training_set_cache = None
+        self.cache = InferenceCache(cache_bytes)
         if filename and os.path.exists(filename):
             logging.info("Loading model from: %s", filename)
             self._model = models.load_model(filename)
@@ -38,18 +111,58 @@ class NN(object):
             logging.info("Starting with clean model")
             self._model = self._get_nn()
             self._model.summary(print_fn=logging.info)
-            utils.plot_model(self._model, to_file=os.path.join(os.path.dirname(__file__), '..', 'model.png'),
-                             show_shapes=True)
+            if is_debug():
+                utils.plot_model(self._model, to_file=os.path.join(os.path.dirname(__file__), '..', 'model.png'),
+                                 show_shapes=True)
 
     def save(self, filename):
         logging.info("Saving model to: %s", filename)
         self._model.save(filename, overwrite=True)
 
-    def inference(self, data):
-        inputs, outputs = self._data_to_training_set(data, True)
-        res = self._model.predict_on_batch(inputs)
-        return [x[0] for x in res]
+    def export_npz(self, filename):
+        """
+        Dumps layer graph and weights for the NumPy-only engine in chessnn.npnn
+        """
+        logging.info("Exporting weights to: %s", filename)
+        config = self._model.get_config()
+        arrays = {}
+        for layer in self._model.layers:
+            for idx, weights in enumerate(layer.get_weights()):
+                arrays["%s/%d" % (layer.name, idx)] = weights
+        graph = json.dumps({
+            "layers": [{"name": x["name"], "class_name": x["class_name"], "config": x["config"],
+                        "inbound": [node[0] for nodes in x["inbound_nodes"] for node in nodes]}
+                       for x in config["layers"]],
+            "inputs": [x[0] for x in config["input_layers"]],
+            "outputs": [x[0] for x in config["output_layers"]],
+        })
+        np.savez_compressed(filename, __graph__=np.frombuffer(graph.encode('utf-8'), dtype=np.uint8), **arrays)
 
+    def inference(self, data):
+        return self.inference_batch(data)[0]
+
+    @timed("inference")
+    def inference_batch(self, data):
+        """
+        Runs single forward pass for whole batch
+
+        :return: list of per-record output lists
+        """
+        keys = [self.cache.key(x) for x in data] if self.cache.max_bytes else [None] * len(data)
+        res = [self.cache.get(key) if key else None for key in keys]
+        missing = [idx for idx, x in enumerate(res) if x is None]
+        if not missing:
+            return res
+
+        inputs, outputs = self._data_to_training_set([data[idx] for idx in missing], True)
+        predicted = self._model.predict_on_batch(inputs)
+        for pos, idx in enumerate(missing):
+            res[idx] = [x[pos] for x in predicted]
+            if keys[idx]:
+                self.cache.put(keys[idx], res[idx])
+        return res
+
+    @timed("train")
     def train(self, data, epochs, validation_data=None):
         logging.info("Preparing training set...")
         inputs, outputs = self._data_to_training_set(data, False)
@@ -62,9 +175,63 @@ class NN(object):
                               callbacks=cbs, verbose=2 if epochs > 1 else 0,
                               epochs=epochs)
         logging.info("Trained: %s", {x: y[-1] for x, y in res.history.items()})
+        self.cache.clear()
 
         if validation_data is not None:
             self.validate(validation_data)
+        self._training_set_cache = None  # don't keep the tensors of a whole training set alive between calls
+
+    @timed("train")
+    def train_stream(self, shards, epochs, batch_size=256, validation_split=0.1):
+        """
+        Trains from stored move records without materializing the whole training set. Batches are encoded on the fly
+        in parallel and prefetched, the tail of every shard is used for validation.
+
+        :param shards: list of MOVE_RECORD_DTYPE arrays, typically memory maps from ShardedMoves.open_shards()
+        """
+        train_batches, valid_batches = [], []
+        for shard_idx, records in enumerate(shards):
+            split = len(records) - int(len(records) * validation_split)
+            for batches, first, last in ((train_batches, 0, split), (valid_batches, split, len(records))):
+                batches.extend((shard_idx, start, min(start + batch_size, last))
+                               for start in range(first, last, batch_size))
+
+        if not train_batches:
+            logging.info("Nothing to train on")
+            return
+
+        logging.info("Streaming %s training and %s validation batches...", len(train_batches), len(valid_batches))
+        cbpath = '/tmp/tensorboard/%d' % (time.time() if epochs > 1 else 0)
+        res = self._model.fit(self._stream_dataset(shards, train_batches, True), epochs=epochs,
+                              steps_per_epoch=len(train_batches),
+                              validation_data=self._stream_dataset(shards, valid_batches) if valid_batches else None,
+                              validation_steps=len(valid_batches) or None,
+                              callbacks=[callbacks.TensorBoard(cbpath)], verbose=2 if epochs > 1 else 0)
+        logging.info("Trained: %s", {x: y[-1] for x, y in res.history.items()})
+        self.cache.clear()
+
+    def _stream_dataset(self, shards, batches, shuffle=False):
+        shapes = [(8, 8, len(PIECE_TYPES) * 2), (3,), (len(MOVES_MAP),), (1,), (len(MOVES_MAP),), (64,), (64,)]
+
+        def load_batch(batch):
+            shard_idx, start, stop = batch
+            records = shards[shard_idx][start:stop]
+            if shuffle:
+                records = records[np.random.permutation(len(records))]
+            inputs, outputs = self._data_to_training_set(MoveRecordStore.from_records(records), False)
+            return tuple(inputs) + tuple(outputs)
+
+        def restructure(*tensors):
+            for tensor, shape in zip(tensors, shapes):
+                tensor.set_shape((None,) + shape)
+            return tuple(tensors[:2]), tuple(tensors[2:])
+
+        dataset = tf.data.Dataset.from_tensor_slices(np.array(batches, dtype=np.int64))
+        if shuffle:
+            dataset = dataset.shuffle(len(batches), reshuffle_each_iteration=True)
+        dataset = dataset.map(lambda batch: tf.numpy_function(load_batch, [batch], [tf.float32] * len(shapes)),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return dataset.map(restructure).repeat().prefetch(tf.data.experimental.AUTOTUNE)
 
     def validate(self, data):
         logging.info("Preparing validation set...")
@@ -175,45 +342,18 @@ class NNChess(NN):
         return conc
 
     def _data_to_training_set(self, data, is_inference=False):
-        batch_len = len(data)
-
-        inputs_pos = np.full((batch_len, 8, 8, len(PIECE_TYPES) * 2), 0.0)
-        inputs_flags = np.full((batch_len, 3), 0.0)
-        out_moves = np.full((batch_len, len(MOVES_MAP)), 0.0)
-        out_possible = np.full((batch_len, len(MOVES_MAP)), 0.0)
-        out_attacks = np.full((batch_len, 64), 0.0)
-        out_threats = np.full((batch_len, 64), 0.0)
-        out_evals = np.full((batch_len, 1), 0.0)
-
-        batch_n = 0
-        for moverec in data:
-            assert isinstance(moverec, MoveRecord)
-
-            evl = moverec.eval
+        if is_inference:
+            return records_to_inputs(data), None
 
-            out_evals[batch_n][0] = evl
-            inputs_pos[batch_n] = moverec.position
+        # only stores can tell they were modified, lists of views would need checking every store they point into
+        if not isinstance(data, MoveRecordStore):
+            return records_to_inputs(data), records_to_outputs(data)
 
-            inputs_flags[batch_n][0] = 1.0 / moverec.full_move
-            inputs_flags[batch_n][1] = 1.0 / (moverec.fifty_progress + 1)
-            inputs_flags[batch_n][2] = moverec.fifty_progress / 100.0
+        # keyed on identity, the cache keeps a reference so the id can't be reused by another object
+        key = (len(data), data.version)
+        if self._training_set_cache and self._training_set_cache[0] is data and self._training_set_cache[1] == key:
+            return self._training_set_cache[2]
 
-            out_moves[batch_n] = np.full((len(MOVES_MAP, )), 0.0 if evl else 1.0 / (len(MOVES_MAP) - 1))
-            out_moves[batch_n][moverec.get_move_num()] = evl
-            out_possible[batch_n] = moverec.possible
-            out_attacks[batch_n] = moverec.attacked
-            out_threats[batch_n] = moverec.defended
-
-            batch_n += 1
-
-        return [inputs_pos, inputs_flags], [out_moves, out_evals, out_possible, out_attacks, out_threats]
-
-    def inference(self, data):
-        inference = super().inference(data)
-        return [self._moves_iter(inference[0])] + inference[1:]
-
-    def _moves_iter(self, scores):
-        for idx, score in sorted(np.ndenumerate(scores), key=itemgetter(1), reverse=True):
-            idx = idx[0]
-            move = chess.Move(MOVES_MAP[idx][0], MOVES_MAP[idx][1])
-            yield move
+        res = records_to_inputs(data), records_to_outputs(data)
+        self._training_set_cache = (data, key, res)
+        return res
@@ -0,0 +1,161 @@
+"""
+NumPy-only forward pass of NNChess, for processes that only need moves and should not load TensorFlow.
+Weights are exported from the Keras model with NN.export_npz(), or by running this module. Entry points taking
+a model file name use load_net(), so giving them an .npz file keeps TensorFlow out of the process.
+"""
+import json
+import logging
+import sys
+
+import numpy as np
+
+from chessnn import records_to_inputs
+from chessnn.metrics import timed
+
+
+def _activation(name, x):
+    if name in (None, "linear"):
+        return x
+    if name == "relu":
+        return np.maximum(x, 0)
+    if name == "sigmoid":
+        return 1.0 / (1.0 + np.exp(-x))
+    if name == "tanh":
+        return np.tanh(x)
+    if name == "elu":
+        return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+    if name == "softmax":
+        exp = np.exp(x - x.max(axis=-1, keepdims=True))
+        return exp / exp.sum(axis=-1, keepdims=True)
+    raise ValueError("Unsupported activation: %s" % name)
+
+
+def _conv2d(config, weights, x):
+    assert config.get("padding", "valid") == "valid", config
+    assert tuple(config.get("strides", (1, 1))) == (1, 1), config
+    assert tuple(config.get("dilation_rate", (1, 1))) == (1, 1), config
+    kernel = weights[0]
+    windows = np.lib.stride_tricks.sliding_window_view(x, kernel.shape[:2], axis=(1, 2))
+    res = np.einsum("nhwcij,ijco->nhwo", windows, kernel, optimize=True)
+    if config.get("use_bias", True):
+        res += weights[1]
+    return _activation(config.get("activation"), res)
+
+
+def _dense(config, weights, x):
+    res = x @ weights[0]
+    if config.get("use_bias", True):
+        res += weights[1]
+    return _activation(config.get("activation"), res)
+
+
+_LAYERS = {
+    "Conv2D": lambda config, weights, inputs: _conv2d(config, weights, inputs[0]),
+    "Dense": lambda config, weights, inputs: _dense(config, weights, inputs[0]),
+    "Flatten": lambda config, weights, inputs: inputs[0].reshape((len(inputs[0]), -1)),
+    "Concatenate": lambda config, weights, inputs: np.concatenate(inputs, axis=config.get("axis", -1)),
+    "Multiply": lambda config, weights, inputs: np.prod(inputs, axis=0),
+    "Activation": lambda config, weights, inputs: _activation(config.get("activation"), inputs[0]),
+    "Dropout": lambda config, weights, inputs: inputs[0],
+}
+
+
+class NNChessNumpy(object):
+    """
+    Drop-in replacement for NNChess inference, same inference() and inference_batch() outputs
+    """
+
+    def __init__(self, filename) -> None:
+        super().__init__()
+        logging.info("Loading exported weights from: %s", filename)
+        with np.load(filename, allow_pickle=False) as data:
+            graph = json.loads(data["__graph__"].tobytes().decode('utf-8'))
+            arrays = {name: data[name].astype(np.float32) for name in data.files if name != "__graph__"}
+
+        self._inputs = graph["inputs"]
+        self._outputs = graph["outputs"]
+        self._layers = []
+        for layer in graph["layers"]:
+            if layer["class_name"] == "InputLayer":
+                continue
+            if layer["class_name"] not in _LAYERS:
+                raise ValueError("Unsupported layer type: %s" % layer["class_name"])
+            weights = []
+            while "%s/%d" % (layer["name"], len(weights)) in arrays:
+                weights.append(arrays["%s/%d" % (layer["name"], len(weights))])
+            self._layers.append((layer["name"], _LAYERS[layer["class_name"]], layer["config"], weights,
+                                 layer["inbound"]))
+
+    def predict_on_batch(self, inputs):
+        values = dict(zip(self._inputs, inputs))
+        for name, func, config, weights, inbound in self._layers:
+            values[name] = func(config, weights, [values[x] for x in inbound])
+        return [values[x] for x in self._outputs]
+
+    def inference(self, data):
+        return self.inference_batch(data)[0]
+
+    @timed("inference")
+    def inference_batch(self, data):
+        res = self.predict_on_batch(records_to_inputs(data))
+        return [[x[idx] for x in res] for idx in range(len(data))]
+
+
+def load_net(filename, **kwargs):
+    """
+    Picks the engine by file type: .npz files exported by NN.export_npz() run on NNChessNumpy without TensorFlow,
+    anything else is loaded as Keras model by NNChess, which gets kwargs.
+
+    :return: object with inference() and inference_batch() for players
+    """
+    if filename and filename.endswith(".npz"):
+        return NNChessNumpy(filename)
+
+    from chessnn.nn import NNChess
+
+    return NNChess(filename, **kwargs)
+
+
+def check_parity(net, engine, records, atol=1e-4):
+    """
+    Compares NumPy engine outputs with Keras model ones, raises AssertionError on mismatch
+    """
+    expected = net.inference_batch(records)
+    actual = engine.inference_batch(records)
+    for exp_rec, act_rec in zip(expected, actual):
+        for exp, act in zip(exp_rec, act_rec):
+            diff = np.max(np.abs(np.asarray(exp) - act))
+            assert diff <= atol, "NumPy engine differs from Keras model by %s" % diff
+    logging.info("Parity check passed on %s positions", len(records))
+
+
+def _sample_records(count, seed=0):
+    import random
+
+    import chess
+
+    from chessnn import BoardOptim, MoveRecord
+
+    rnd = random.Random(seed)
+    records = []
+    while len(records) < count:
+        board = BoardOptim.from_chess960_pos(rnd.randint(0, 959))
+        for _ in range(rnd.randint(0, 80)):
+            moves = list(board.generate_legal_moves())
+            if not moves:
+                break
+            board.push(rnd.choice(moves))
+        pos = board.get_position(board.turn == chess.BLACK)
+        records.append(MoveRecord(pos, chess.Move.null(), None, board.fullmove_number, board.halfmove_clock))
+    return records
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from chessnn.nn import NNChess
+
+    src = sys.argv[1] if len(sys.argv) > 1 else "nn.hdf5"
+    dst = sys.argv[2] if len(sys.argv) > 2 else "nn.npz"
+    keras_nn = NNChess(src, cache_bytes=0)
+    keras_nn.export_npz(dst)
+    check_parity(keras_nn, NNChessNumpy(dst), _sample_records(64))
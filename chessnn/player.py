@@ -1,4 +1,6 @@
+import copy
 import logging
+import time
 from abc import abstractmethod
 from typing import List, Union
 
@@ -7,7 +9,8 @@ import numpy as np
 from chess import BaseBoard
 from chess.engine import SimpleEngine, INFO_SCORE
 
-from chessnn import MoveRecord, BoardOptim, nn, is_debug, MOVES_MAP
+from chessnn import MoveRecord, BoardOptim, nn, is_debug, moves_to_indices, MOVES_FLIP, SQUARES_FLIP
+from chessnn.metrics import metrics, timed
 
 
 class PlayerBase(object):
@@ -22,6 +25,16 @@ class PlayerBase(object):
         self.board = None
         self.moves_log = []
 
+    def spawn(self):
+        """
+        Makes a copy of player to take part in another simultaneous game
+        """
+        player = copy.copy(self)
+        # noinspection PyTypeChecker
+        player.board = None
+        player.moves_log = []
+        return player
+
     def get_moves(self):
         res = []
         for x in self.moves_log:
@@ -29,8 +42,8 @@ class PlayerBase(object):
         self.moves_log.clear()
         return res
 
-    def makes_move(self, in_round):
-        move, geval, maps_predicted = self._choose_best_move()
+    def makes_move(self, in_round, choice=None):
+        move, geval, maps_predicted = choice if choice else self._choose_best_move()
         moverec = self._get_moverec(move, geval, in_round)
         maps_actual = (moverec.possible, moverec.attacked, moverec.defended)
         if is_debug() and maps_predicted:
@@ -39,21 +52,23 @@ class PlayerBase(object):
         self.board.push(move)
         if is_debug():
             logging.debug("%d. %r %.2f\n%s", self.board.fullmove_number, move.uci(), geval, self.board.unicode())
-        not_over = move != chess.Move.null() and not self.board.is_game_over(claim_draw=False)
+        with metrics.timer("game_over_check"):
+            not_over = move != chess.Move.null() and not self.board.is_game_over(claim_draw=False)
         return not_over
 
+    @timed("encode")
     def _get_moverec(self, move, geval, in_round):
-        bflip: BoardOptim = self.board if self.color == chess.WHITE else self.board.mirror()
-        pos = bflip.get_position()
-        moveflip = move if self.color == chess.WHITE else self._mirror_move(move)
+        flip = self.color == chess.BLACK
+        pos = self.board.get_position(flip)
+        moveflip = self._mirror_move(move) if flip else move
         piece = self.board.piece_at(move.from_square)
         piece_type = piece.piece_type if piece else None
         moverec = MoveRecord(pos, moveflip, piece_type, self.board.fullmove_number, self.board.halfmove_clock)
         moverec.from_round = in_round
         moverec.eval = geval
 
-        moverec.attacked, moverec.defended = bflip.get_attacked_defended()
-        moverec.possible = bflip.get_possible_moves()
+        moverec.attacked, moverec.defended = self.board.get_attacked_defended(flip)
+        moverec.possible = self.board.get_possible_moves(flip)
 
         return moverec
 
@@ -73,16 +88,8 @@ class PlayerBase(object):
         :type move: chess.Move
         """
 
-        def flip(pos):
-            arr = np.full((64,), False)
-            arr[pos] = True
-            arr = np.reshape(arr, (-1, 8))
-            arr = np.flipud(arr)
-            arr = arr.flatten()
-            res = arr.argmax()
-            return int(res)
-
-        new_move = chess.Move(flip(move.from_square), flip(move.to_square), move.promotion, move.drop)
+        new_move = chess.Move(int(SQUARES_FLIP[move.from_square]), int(SQUARES_FLIP[move.to_square]), move.promotion,
+                              move.drop)
         return new_move
 
     @abstractmethod
@@ -92,39 +99,251 @@ class PlayerBase(object):
 
 class NNPLayer(PlayerBase):
     nn: nn.NN
+    policy_only = True  # the move comes from one inference of the current position, callers may batch it
 
-    def __init__(self, name, color, net) -> None:
+    def __init__(self, name, color, net, temperature=0.0) -> None:
         super().__init__(name, color)
         self.nn = net
         self.invalid_moves = 0
+        self.temperature = temperature
+
+    def spawn(self):
+        player = super().spawn()
+        player.invalid_moves = 0
+        return player
 
     def _choose_best_move(self):
-        if self.color == chess.WHITE:
-            pos = self.board.get_position()
-        else:
-            pos = self.board.mirror().get_position()
-        moverec = MoveRecord(pos, chess.Move.null(), None, self.board.fullmove_number, self.board.halfmove_clock)
-        movegen, geval, possible, attacked, defended = self.nn.inference([moverec])
-        return self._scores_to_move(movegen), geval[0], (possible, attacked, defended)
-
-    def _scores_to_move(self, movegen):
-        cnt = 0
-        for move in movegen:
-            if self.color == chess.BLACK:
-                flipped = self._mirror_move(move)
-                move = flipped
-
-            if not self.board.is_legal(move):
-                cnt += 1
-                continue
-
-            break
-        else:
+        return self.choice_from_inference(self.nn.inference([self.get_inference_record()]))
+
+    def get_inference_record(self):
+        # from the side to move point of view, which is also what search positions need
+        pos = self.board.get_position(self.board.turn == chess.BLACK)
+        return MoveRecord(pos, chess.Move.null(), None, self.board.fullmove_number, self.board.halfmove_clock)
+
+    def choice_from_inference(self, prediction):
+        """
+        Turns NN outputs for the record from get_inference_record into the choice accepted by makes_move
+        """
+        scores, geval, possible, attacked, defended = prediction
+        return self._scores_to_move(scores), geval[0], (possible, attacked, defended)
+
+    def _legal_moves_scored(self, scores):
+        """
+        :return: legal moves, one per MOVES_MAP entry (queen for promotions), and their scores
+        """
+        moves = list(self.board.generate_legal_moves())
+        if not moves:
+            return [], np.zeros(0, dtype=scores.dtype)
+
+        squares = np.array([(move.from_square, move.to_square) for move in moves])
+        indices = moves_to_indices(squares[:, 0], squares[:, 1])
+        if self.board.turn == chess.BLACK:
+            indices = MOVES_FLIP[indices]  # NN sees black's position mirrored
+        indices, first = np.unique(indices, return_index=True)
+        return [moves[x] for x in first], scores[indices]
+
+    @timed("select")
+    def _scores_to_move(self, scores):
+        moves, legal_scores = self._legal_moves_scored(scores)
+        if not moves:
             logging.warning("No valid moves")
-            move = chess.Move.null()
+            return chess.Move.null()
+
+        best = int(np.argmax(legal_scores))
+        choice = best
+        if self.temperature:
+            logits = np.log(np.maximum(legal_scores, 1e-12)) / self.temperature
+            probs = np.exp(logits - logits.max())
+            choice = int(np.random.choice(len(moves), p=probs / probs.sum()))
+
+        # same number as illegal candidates skipped when probing moves in order of score
+        cnt = int(np.count_nonzero(scores > legal_scores[best]))
         logging.debug("Invalid moves skipped: %s", cnt)
         self.invalid_moves += cnt
-        return move
+        return moves[choice]
+
+
+class _SearchNode(object):
+    __slots__ = ('move', 'children', 'value', 'policy', 'terminal', 'visited')
+
+    def __init__(self, move) -> None:
+        super().__init__()
+        self.move = move
+        self.children = None
+        self.value = 0.0  # negamax value for the side to move at this node
+        self.policy = None
+        self.terminal = False
+        self.visited = False
+
+
+class _SearchAborted(Exception):
+    pass
+
+
+class NNSearchPlayer(NNPLayer):
+    """
+    Iterative deepening alpha-beta on top of NNChess: the "moves" head orders and limits candidate moves,
+    the "eval" head scores leaves. New leaves of a depth step are evaluated in inference batches of up to batch_size,
+    and only leaves reached by the previous alpha-beta pass (not pruned) are expanded further.
+    Once the first depth is done, a step running out of time or aborted is dropped and the last result is kept.
+    """
+    policy_only = False
+
+    def __init__(self, name, color, net, width=6, max_depth=6, time_budget=1.0, node_budget=5000,
+                 batch_size=256) -> None:
+        super().__init__(name, color, net)
+        self.width = width
+        self.max_depth = max_depth
+        self.time_budget = time_budget
+        self.node_budget = node_budget
+        self.batch_size = batch_size
+        self._search_started = None
+        self._interruptible = False
+        self.nodes = 0
+        self.depth = 0
+        self.score = 0.0
+        self.pv = []
+
+    def _choose_best_move(self):
+        started = time.time()
+        prediction = self.nn.inference([self.get_inference_record()])
+        scores, geval, possible, attacked, defended = prediction
+        maps = (possible, attacked, defended)
+
+        root = _SearchNode(None)
+        root.policy = scores
+        root.visited = True
+        self.nodes = 1
+        self.depth = 0
+        self.score = 0.0
+        self.pv = []
+        self._search_started = started
+        self._interruptible = False
+        best = None
+        for depth in range(1, self.max_depth + 1):
+            step_started = time.time()
+            records, leaves = [], []
+            try:
+                self._expand(root, records, leaves)
+                if not leaves or (best and self.nodes + len(records) > self.node_budget):
+                    break
+                self._evaluate([x for x in leaves if not x.terminal], records)
+            except _SearchAborted:
+                logging.debug("Depth %s aborted after %.3fs", depth, time.time() - step_started)
+                break
+            self.nodes += len(leaves)
+
+            self._reset_visited(root)
+            self._alphabeta(root, -np.inf, np.inf)
+            best = root.children[0]
+            self.depth = depth
+            self.score = root.value
+            self.pv = self._principal_variation(root)
+            self._interruptible = True
+            self.on_depth()
+
+            now = time.time()
+            # next step is roughly width times larger than this one
+            if now - started + (now - step_started) * self.width > self.time_budget or self.stop_requested():
+                break
+
+        if best is None:
+            logging.warning("No valid moves")
+            return chess.Move.null(), geval[0], maps
+
+        logging.debug("Searched %s nodes to depth %s in %.3fs, score %.3f", self.nodes, self.depth,
+                      time.time() - started, self.score)
+        return best.move, geval[0], maps
+
+    def on_depth(self):
+        """
+        Called after every completed depth, when depth, nodes, score and pv are up to date
+        """
+
+    def stop_requested(self):
+        """
+        Checked after every completed depth, True ends the search with its result
+        """
+        return False
+
+    def abort_requested(self):
+        """
+        Polled for every expanded node and inference batch, True drops the unfinished depth. Has to be cheap.
+        """
+        return False
+
+    def _check_abort(self):
+        if self._interruptible and (self.abort_requested() or time.time() - self._search_started > self.time_budget):
+            raise _SearchAborted()
+
+    def _evaluate(self, leaves, records):
+        for start in range(0, len(records), self.batch_size):
+            self._check_abort()
+            batch = records[start:start + self.batch_size]
+            for leaf, (leaf_scores, leaf_eval, _, _, _) in zip(leaves[start:], self.nn.inference_batch(batch)):
+                leaf.policy = leaf_scores
+                leaf.value = 2.0 * float(leaf_eval[0]) - 1.0
+
+    def _principal_variation(self, node):
+        res = []
+        while node.children and node.children[0].visited:
+            node = node.children[0]
+            res.append(node.move)
+        return res
+
+    def _expand(self, node, records, leaves):
+        if node.terminal or not node.visited:
+            return
+        self._check_abort()
+
+        if node.children is not None:
+            for child in node.children:
+                self.board.push(child.move)
+                try:
+                    self._expand(child, records, leaves)
+                finally:
+                    self.board.pop()
+            return
+
+        moves, legal_scores = self._legal_moves_scored(node.policy)
+        order = np.argsort(-legal_scores, kind="stable")[:self.width]
+        node.children = []
+        for idx in order:
+            child = _SearchNode(moves[idx])
+            node.children.append(child)
+            leaves.append(child)
+            self.board.push(child.move)
+            try:
+                if self.board.is_game_over(claim_draw=False):
+                    child.terminal = True
+                    child.value = -1.0 if self.board.is_checkmate() else 0.0
+                else:
+                    records.append(self.get_inference_record())
+            finally:
+                self.board.pop()
+
+    def _reset_visited(self, node):
+        node.visited = False
+        for child in node.children or ():
+            self._reset_visited(child)
+
+    def _alphabeta(self, node, alpha, beta):
+        node.visited = True
+        if not node.children:
+            return node.value
+
+        best = -np.inf
+        for child in node.children:
+            value = -self._alphabeta(child, -beta, -alpha)
+            best = max(best, value)
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        # best replies first for the next iteration, pruned children keep their older values
+        node.children.sort(key=lambda x: x.value)
+        node.value = best
+        return best
 
 
 class Stockfish(PlayerBase):
@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from chessnn import MOVE_RECORD_DTYPE, MoveRecordStore
+
+INDEX_FILE = "index.json"
+FORMAT_VERSION = 1
+
+
+def _replace_atomic(fname, writer):
+    # temp name unique per call, several processes and threads may replace the same file
+    handle, tmp = tempfile.mkstemp(prefix=os.path.basename(fname) + ".", suffix=".tmp",
+                                   dir=os.path.dirname(fname) or ".")
+    try:
+        with os.fdopen(handle, "wb") as fhd:
+            writer(fhd)
+            fhd.flush()
+            os.fsync(fhd.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ShardedMoves(object):
+    """
+    On-disk move records as a directory of fixed-width MOVE_RECORD_DTYPE ``.npy`` shards plus a JSON index.
+    Shards are written once and never modified, the index is replaced atomically after each append,
+    so a crash leaves the previous state readable. Readers get read-only memory maps of the shards.
+    """
+
+    def __init__(self, path) -> None:
+        super().__init__()
+        self.path = path
+        self.index = self._read_index()
+
+    def _read_index(self):
+        fname = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(fname):
+            return {"version": FORMAT_VERSION, "dtype": MOVE_RECORD_DTYPE.descr, "next": 0, "min_round": 0,
+                    "shards": []}
+
+        with open(fname) as fhd:
+            index = json.load(fhd)
+
+        if index["version"] != FORMAT_VERSION or np.dtype([tuple(x) for x in index["dtype"]]) != MOVE_RECORD_DTYPE:
+            raise ValueError("Incompatible move records format in %s" % self.path)
+
+        return index
+
+    def _write_index(self):
+        data = json.dumps(self.index, indent=1).encode('ascii')
+        _replace_atomic(os.path.join(self.path, INDEX_FILE), lambda fhd: fhd.write(data))
+
+    def __len__(self):
+        return sum(shard["count"] for shard in self.index["shards"])
+
+    def get_meta(self, key, default=None):
+        return self.index.get("meta", {}).get(key, default)
+
+    def append(self, records, meta=None):
+        """
+        :param records: structured array of MOVE_RECORD_DTYPE
+        :param meta: optional dict of entries to keep in the index, stored in the same atomic update as the records
+        """
+        if meta:
+            self.index.setdefault("meta", {}).update(meta)
+
+        if not len(records):
+            if meta:
+                os.makedirs(self.path, exist_ok=True)
+                self._write_index()
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        name = "shard-%06d.npy" % self.index["next"]
+        _replace_atomic(os.path.join(self.path, name), lambda fhd: np.save(fhd, records, allow_pickle=False))
+
+        self.index["next"] += 1
+        self.index["shards"].append({
+            "file": name,
+            "count": len(records),
+            "min_round": int(records["from_round"].min()),
+            "max_round": int(records["from_round"].max()),
+        })
+        self._write_index()
+        self._cleanup()
+
+    def retain(self, min_round):
+        """
+        Hides records older than min_round from readers, dropping the shards that have nothing newer
+        """
+        if min_round <= self.index["min_round"]:
+            return
+
+        shards = [x for x in self.index["shards"] if x["max_round"] >= min_round]
+        logging.debug("Dropping %s shards older than round %s", len(self.index["shards"]) - len(shards), min_round)
+        self.index["shards"] = shards
+        self.index["min_round"] = min_round
+        self._write_index()
+        self._cleanup()
+
+    def _cleanup(self):
+        known = {x["file"] for x in self.index["shards"]}
+        for name in os.listdir(self.path):
+            if name.startswith("shard-") and name not in known:
+                os.remove(os.path.join(self.path, name))
+
+    def open_shards(self):
+        """
+        :return: list of read-only memory-mapped MOVE_RECORD_DTYPE arrays, one per shard
+        """
+        return [np.load(os.path.join(self.path, x["file"]), mmap_mode='r', allow_pickle=False)
+                for x in self.index["shards"]]
+
+    def iter_records(self):
+        """
+        Yields shard contents in append order, skipping records older than the retained round
+        """
+        for records in self.open_shards():
+            if records["from_round"].min() < self.index["min_round"]:
+                records = records[records["from_round"] >= self.index["min_round"]]
+            yield records
+
+    def load(self):
+        store = MoveRecordStore(len(self))
+        for records in self.iter_records():
+            store.extend_records(records)
+        return store
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import random
+import sys
+
+import chess
+import chess.engine
+import chess.variant
+
+from chessnn import BoardOptim, MoveRecordStore, FLAG_EVAL
+from chessnn.labeler import EngineLabeler, label_records
+from chessnn.player import NNPLayer
+
+STAND_IN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks", "labeler.py")
+
+
+def _stand_in(crash_rate=0.0):
+    return [sys.executable, STAND_IN, "--stand-in", "--crash-rate", str(crash_rate)]
+
+
+def _boards(count, seed=0):
+    rnd = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        board = BoardOptim.from_chess960_pos(rnd.randint(0, 959))
+        for _ in range(rnd.randint(0, 40)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rnd.choice(moves))
+        if not board.is_game_over():
+            boards.append(board)
+    return boards
+
+
+def _label(labeler, boards):
+    async def run():
+        async with labeler:
+            return await labeler.label(boards)
+
+    return asyncio.run(run())
+
+
+def test_labels():
+    board = chess.Board()
+    labels = _label(EngineLabeler(_stand_in(), 2), [board])
+    assert labels[0].cp == 0
+    assert labels[0].mate is None
+    assert labels[0].eval == 0.5
+    assert labels[0].move == next(iter(board.legal_moves))
+
+
+def test_crashed_engines_are_restarted():
+    boards = _boards(200)
+    labeler = EngineLabeler(_stand_in(0.05), 2, retries=10)
+    labels = _label(labeler, boards)
+    assert labeler.restarts > 0
+    assert labeler.failures == 0
+    assert labeler.positions == len(boards)
+    assert all(0.0 <= label.eval <= 1.0 for label in labels)
+
+
+def test_rejected_position_is_not_retried():
+    boards = [chess.variant.AtomicBoard(), chess.Board()]
+    labeler = EngineLabeler(_stand_in(), 1)
+    labels = _label(labeler, boards)
+    assert labels[0] is None
+    assert labels[1] is not None
+    assert labeler.failures == 1
+    assert labeler.restarts == 0
+
+
+def test_label_records():
+    store = MoveRecordStore()
+    for board in _boards(20, seed=1):
+        player = NNPLayer("test", board.turn, None)
+        player.board = board
+        store.append(player._get_moverec(next(iter(board.legal_moves)), None, 0))
+    records = store.to_records()
+    assert not (records["flags"] & FLAG_EVAL).any()
+
+    async def run():
+        async with EngineLabeler(_stand_in(), 2) as labeler:
+            return await label_records(labeler, records, batch_size=8)
+
+    labeled = asyncio.run(run())
+    assert (labeled["flags"] & FLAG_EVAL).all()
+    assert ((labeled["eval"] >= 0) & (labeled["eval"] <= 1)).all()
+    assert (labeled["move"] == records["move"]).all()
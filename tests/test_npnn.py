@@ -0,0 +1,20 @@
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from chessnn import nn  # noqa: E402
+from chessnn.npnn import NNChessNumpy, check_parity, load_net, _sample_records  # noqa: E402
+
+
+def test_numpy_engine_matches_keras(tmp_path):
+    nn._import_tf()
+    set_seed = getattr(tf.random, "set_seed", None) or tf.random.set_random_seed
+    set_seed(42)
+    net = nn.NNChess(None, cache_bytes=0)
+    fname = str(tmp_path / "nn.npz")
+    net.export_npz(fname)
+
+    engine = load_net(fname)
+    assert isinstance(engine, NNChessNumpy)
+    check_parity(net, engine, _sample_records(64))
+    check_parity(net, engine, _sample_records(1, seed=1))
@@ -1,4 +1,10 @@
+import argparse
+import atexit
+import collections
+import heapq
+import itertools
 import logging
+import multiprocessing
 import os
 import pickle
 import random
@@ -6,18 +12,41 @@ import sys
 
 from chess import WHITE, BLACK, Move
 
-from chessnn import BoardOptim, is_debug
+from chessnn import BoardOptim, is_debug, MoveRecordStore
+from chessnn.archive import GameArchive
+from chessnn.metrics import metrics, timed
 from chessnn.nn import NNChess
+from chessnn.npnn import load_net
 from chessnn.player import NNPLayer, Stockfish
+from chessnn.shards import ShardedMoves
 
 
-def play_one_game(pwhite, pblack, rnd):
+ARCHIVE_DIR = os.path.join(os.path.dirname(__file__), "games")
+LATEST_GAME = os.path.join(os.path.dirname(__file__), "last.pgn")
+
+_archive = None
+
+
+def get_archive():
+    """
+    Archive of this process, created on first use. Every process writes its own segments and index.
+    """
+    global _archive
+    if _archive is None:
+        _archive = GameArchive(ARCHIVE_DIR, "games-%s" % multiprocessing.current_process().name, latest=LATEST_GAME)
+        atexit.register(_archive.close)
+    return _archive
+
+
+def play_one_game(pwhite, pblack, rnd, archive=None):
     """
 
     :type pwhite: NNPLayer
     :type pblack: NNPLayer
     :type rnd: int
+    :type archive: GameArchive
     """
+    archive = archive or get_archive()
     board: BoardOptim = BoardOptim.from_chess960_pos(rnd % 960)
     pwhite.board = board
     pblack.board = board
@@ -30,7 +59,7 @@ def play_one_game(pwhite, pblack, rnd):
                 break
 
             if is_debug():
-                board.write_pgn(pwhite, pblack, os.path.join(os.path.dirname(__file__), "last.pgn"), rnd)
+                archive.add(board, pwhite.name, pblack.name, rnd, final=False)
     except:
         last = board.move_stack[-1] if board.move_stack else Move.null()
         logging.warning("Final move: %s %s %s", last, last.from_square, last.to_square)
@@ -38,8 +67,57 @@ def play_one_game(pwhite, pblack, rnd):
         raise
     finally:
         if board.move_stack:
-            board.write_pgn(pwhite, pblack, os.path.join(os.path.dirname(__file__), "last.pgn"), rnd)
+            archive.add(board, pwhite.name, pblack.name, rnd)
+
+    return _finish_game(board, pwhite, pblack, rnd)
+
+
+def play_games(pairs, rounds, archive=None):
+    """
+    Plays several games at once. On every step, positions of all games waiting for a move from NNPLayer
+    are sent to the network as one inference batch. Players searching beyond the policy move their own way.
+
+    :type pairs: list[tuple[PlayerBase, PlayerBase]]
+    :type rounds: list[int]
+    :type archive: GameArchive
+    :return: list of results
+    """
+    archive = archive or get_archive()
+    boards = []
+    for (pwhite, pblack), rnd in zip(pairs, rounds):
+        board = BoardOptim.from_chess960_pos(rnd % 960)
+        pwhite.board = board
+        pblack.board = board
+        boards.append(board)
+
+    active = list(range(len(pairs)))
+    while active:
+        batches = collections.defaultdict(list)
+        finished = set()
+        for idx in active:
+            player = pairs[idx][0] if boards[idx].turn == WHITE else pairs[idx][1]
+            if isinstance(player, NNPLayer) and player.policy_only:
+                batches[player.nn].append((idx, player))
+            elif not player.makes_move(rounds[idx]):
+                finished.add(idx)
+
+        for net, waiting in batches.items():
+            predictions = net.inference_batch([player.get_inference_record() for _, player in waiting])
+            for (idx, player), prediction in zip(waiting, predictions):
+                if not player.makes_move(rounds[idx], player.choice_from_inference(prediction)):
+                    finished.add(idx)
+
+        active = [idx for idx in active if idx not in finished]
+
+    results = []
+    for (pwhite, pblack), rnd, board in zip(pairs, rounds, boards):
+        if board.move_stack:
+            archive.add(board, pwhite.name, pblack.name, rnd)
+        results.append(_finish_game(board, pwhite, pblack, rnd))
+    return results
 
+
+def _finish_game(board, pwhite, pblack, rnd):
     result = board.result(claim_draw=True)
 
     badp = 0
@@ -58,51 +136,124 @@ def play_one_game(pwhite, pblack, rnd):
 
     logging.info("Game #%d/%d:\t%s by %s,\t%d moves, %d%% bad", rnd, rnd % 960, result, board.explain(),
                  board.fullmove_number, badp)
+    metrics.game_finished(rnd, result, len(board.move_stack))
 
     return result
 
 
+EVICT_OLDEST_ROUND = "oldest_round"
+EVICT_FIFO = "fifo"
+EVICT_RESERVOIR = "reservoir"
+
+
 class DataSet(object):
-    def __init__(self, fname) -> None:
+    """
+    Bounded buffer of move records. Once capacity is reached, each new record replaces one picked by eviction
+    strategy: a record of the lowest from_round, the oldest inserted record, or a random one (reservoir sampling).
+    """
+
+    def __init__(self, fname, capacity=50000, eviction=EVICT_OLDEST_ROUND) -> None:
         super().__init__()
+        assert eviction in (EVICT_OLDEST_ROUND, EVICT_FIFO, EVICT_RESERVOIR), eviction
         self.fname = fname
-        self.dataset = []
+        self.capacity = capacity
+        self.eviction = eviction
+        self.dataset = MoveRecordStore(min(capacity, 1024))
+        self._shards = ShardedMoves(fname)
+        self._pending = MoveRecordStore()
+        self._seen = 0
+        self._next = 0
+        self._buckets = {}  # round -> slots holding its records
+        self._rounds = []  # heap of the rounds in _buckets, rounds can arrive out of order from workers
 
     def dump_moves(self):
-        if os.path.exists(self.fname):
-            os.rename(self.fname, self.fname + ".bak")
-        try:
-            with open(self.fname, "wb") as fhd:
-                pickle.dump(self.dataset, fhd)
-        except:
-            os.rename(self.fname + ".bak", self.fname)
+        self._shards.append(self._pending.to_records())
+        self._pending = MoveRecordStore()
+        if len(self.dataset):
+            self._shards.retain(int(self.dataset.column("from_round").min()))
 
     def load_moves(self):
-        if os.path.exists(self.fname):
-            with open(self.fname, 'rb') as fhd:
-                loaded = pickle.load(fhd)
-                self.dataset.extend(loaded)
-
+        for records in self._shards.iter_records():
+            take = min(self.capacity - len(self.dataset), len(records))
+            if take:
+                start = len(self.dataset)
+                self.dataset.extend_records(records[:take])
+                for slot, rnd in enumerate(records["from_round"][:take].tolist(), start):
+                    self._register(slot, rnd)
+                self._seen += take
+
+            if take < len(records):
+                rest = MoveRecordStore(len(records) - take)
+                rest.extend_records(records[take:])
+                for moverec in rest:
+                    self._insert(moverec)
+
+        legacy = os.path.splitext(self.fname)[0] + ".pkl"
+        if not len(self.dataset) and os.path.exists(legacy):
+            logging.info("Converting legacy dataset: %s", legacy)
+            with open(legacy, 'rb') as fhd:
+                self.update(pickle.load(fhd))
+            self.dump_moves()
+
+    def stored_records(self):
+        """
+        :return: list of on-disk record arrays, memory-mapped where possible
+        """
+        return list(self._shards.iter_records())
+
+    def last_round(self):
+        return int(self.dataset.column("from_round").max()) if len(self.dataset) else 0
+
+    @timed("dataset.update")
     def update(self, moves):
         lprev = len(self.dataset)
         for move in moves:
-            if move.ignore:
-                move.forced_eval = 0
+            self._pending.append(move)
+            self._insert(move)
 
-        self.dataset.extend(moves)
         if len(self.dataset) - lprev < len(moves):
             logging.debug("partial increase")
-        elif len(self.dataset) - lprev == len(moves):
-            logging.debug("full increase")
         else:
-            logging.debug("no increase")
+            logging.debug("full increase")
 
-        while len(self.dataset) > 50000:
-            mmin = min([x.from_round for x in self.dataset])
-            logging.info("Removing things older than %s", mmin)
-            for x in list(self.dataset):
-                if x.from_round <= mmin:
-                    self.dataset.remove(x)
+    def _insert(self, moverec):
+        self._seen += 1
+        if len(self.dataset) < self.capacity:
+            slot = self.dataset.append(moverec)
+        else:
+            slot = self._evict()
+            if slot is None:
+                return
+            self.dataset.put(slot, moverec)
+
+        self._register(slot, moverec.from_round)
+
+    def _register(self, slot, rnd):
+        if self.eviction == EVICT_OLDEST_ROUND:
+            slots = self._buckets.get(rnd)
+            if slots is None:
+                slots = self._buckets[rnd] = []
+                heapq.heappush(self._rounds, rnd)
+            slots.append(slot)
+
+    def _evict(self):
+        if self.eviction == EVICT_FIFO:
+            slot = self._next
+            self._next = (self._next + 1) % self.capacity
+            return slot
+
+        if self.eviction == EVICT_RESERVOIR:
+            slot = random.randrange(self._seen)
+            return slot if slot < self.capacity else None
+
+        oldest = self._rounds[0]
+        slots = self._buckets[oldest]
+        slot = slots.pop()
+        if not slots:
+            logging.debug("Evicted the last record of round %s", oldest)
+            del self._buckets[oldest]
+            heapq.heappop(self._rounds)
+        return slot
 
 
 def set_to_file(draw, param):
@@ -112,39 +263,146 @@ def set_to_file(draw, param):
         fhd.writelines(lines)
 
 
-def play_with_score(pwhite, pblack):
-    winning = DataSet("winning.pkl")
+def play_with_score(pwhite, pblack, net, streaming=False, concurrency=1):
+    winning = DataSet("winning.moves")
     winning.load_moves()
-    losing = DataSet("losing.pkl")
+    losing = DataSet("losing.moves")
     losing.load_moves()
-    draw = DataSet("losing.pkl")
+    draw = DataSet("losing.moves")
 
-    rnd = max([x.from_round for x in winning.dataset + losing.dataset]) if winning.dataset else 0
+    rnd = max(winning.last_round(), losing.last_round()) if len(winning.dataset) else 0
+    pairs = [(pwhite, pblack)] + [(pwhite.spawn(), pblack.spawn()) for _ in range(concurrency - 1)]
     while True:
-        if not ((rnd+1) % 960):
-            _retrain(winning, losing, draw)
+        rounds = list(range(rnd, rnd + concurrency))
+        if any(not ((x + 1) % 960) for x in rounds):
+            _retrain(net, winning, losing, draw, streaming)
+
+        if concurrency > 1:
+            results = play_games(pairs, rounds)
+        else:
+            results = [play_one_game(pwhite, pblack, rnd)]
+
+        for (pw, pb), result in zip(pairs, results):
+            wmoves = pw.get_moves()
+            bmoves = pb.get_moves()
+            good_moves = _fill_sets(result, wmoves, bmoves, losing, winning, draw)
+            if good_moves and True:
+                moves = wmoves + bmoves
+                random.shuffle(moves)
+                net.train(moves, 1)
+        rnd += concurrency
+
+
+def play_distributed(net, workers, concurrency=1, versus_stockfish=False, publish_every=100, streaming=False):
+    """
+    Runs self-play in worker processes, each with its own read-only copy of the model, while this process
+    collects finished games, trains and periodically publishes new weights for the workers to reload.
+    Weights are published as .npz export too, workers run it on the NumPy engine without loading TensorFlow.
+    """
+    winning = DataSet("winning.moves")
+    winning.load_moves()
+    losing = DataSet("losing.moves")
+    losing.load_moves()
+    draw = DataSet("losing.moves")
+    rnd = max(winning.last_round(), losing.last_round()) if len(winning.dataset) else 0
 
-        result = play_one_game(pwhite, pblack, rnd)
-        wmoves = pwhite.get_moves()
-        bmoves = pblack.get_moves()
-        good_moves = _fill_sets(result, wmoves, bmoves, losing, winning, draw)
-        if good_moves and True:
-            moves = wmoves + bmoves
-            random.shuffle(moves)
-            nn.train(moves, 1)
-        rnd += 1
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue(maxsize=workers * concurrency * 2)
+    version = ctx.Value('i', 0)
+    _publish_weights(net, version)
 
+    procs = [ctx.Process(target=_selfplay_worker, name="selfplay-%d" % idx, daemon=True,
+                         args=(queue, version, rnd + idx, workers, concurrency, versus_stockfish))
+             for idx in range(workers)]
+    for proc in procs:
+        proc.start()
 
-def _retrain(winning, losing, draw):
+    games = 0
+    try:
+        while True:
+            game_round, result, wrecords, brecords = queue.get()
+            wmoves = list(MoveRecordStore.from_records(wrecords))
+            bmoves = list(MoveRecordStore.from_records(brecords))
+            good_moves = _fill_sets(result, wmoves, bmoves, losing, winning, draw)
+            if good_moves:
+                moves = wmoves + bmoves
+                random.shuffle(moves)
+                net.train(moves, 1)
+
+            games += 1
+            if not ((game_round + 1) % 960):
+                _retrain(net, winning, losing, draw, streaming)
+                _publish_weights(net, version)
+            elif not games % publish_every:
+                _publish_weights(net, version)
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+
+def _publish_weights(net, version, fname="nn.hdf5", export="nn.npz"):
+    tmp = fname + ".tmp.hdf5"
+    net.save(tmp)
+    os.replace(tmp, fname)
+    tmp = export + ".tmp.npz"
+    net.export_npz(tmp)
+    os.replace(tmp, export)
+    with version.get_lock():
+        version.value += 1
+    logging.info("Published weights version %s", version.value)
+
+
+def _selfplay_worker(queue, version, first_round, step, concurrency, versus_stockfish, fname="nn.npz"):
+    logging.basicConfig(level=logging.INFO, format="%(processName)s %(levelname)s %(message)s")
+    metrics.enable_from_env(multiprocessing.current_process().name)
+    loaded = version.value
+    net = load_net(fname)
+    pairs = [(NNPLayer("Lisa", WHITE, net), Stockfish(BLACK) if versus_stockfish else NNPLayer("Karen", BLACK, net))
+             for _ in range(concurrency)]
+
+    rnd = first_round
+    try:
+        while True:
+            if version.value != loaded:
+                loaded = version.value
+                logging.info("Reloading weights version %s", loaded)
+                net = load_net(fname)
+                for player in itertools.chain.from_iterable(pairs):
+                    if isinstance(player, NNPLayer):
+                        player.nn = net
+
+            rounds = [rnd + step * idx for idx in range(concurrency)]
+            results = play_games(pairs, rounds)
+            for (pwhite, pblack), game_round, result in zip(pairs, rounds, results):
+                queue.put((game_round, result, _to_records(pwhite.get_moves()), _to_records(pblack.get_moves())))
+            rnd += step * concurrency
+    finally:
+        for player in itertools.chain.from_iterable(pairs):
+            if isinstance(player, Stockfish):
+                player.engine.quit()
+
+
+def _to_records(moves):
+    store = MoveRecordStore(len(moves))
+    store.extend(moves)
+    return store.to_records()
+
+
+def _retrain(net, winning, losing, draw, streaming=False):
     logging.info("W: %s\tL: %s\tD: %s", len(winning.dataset), len(losing.dataset), len(draw.dataset))
     winning.dump_moves()
     losing.dump_moves()
 
-    lst = list(winning.dataset + losing.dataset)
+    if streaming:
+        net.train_stream(winning.stored_records() + losing.stored_records(), 20)
+        net.save("nn.hdf5")
+        return
+
+    lst = list(winning.dataset) + list(losing.dataset)
     random.shuffle(lst)
     if lst:
-        nn.train(lst, 20)
-        nn.save("nn.hdf5")
+        net.train(lst, 20)
+        net.save("nn.hdf5")
         #raise ValueError()
 
     # winning.dataset.clear()
@@ -181,19 +439,30 @@ def _fill_sets(result, wmoves, bmoves, losing, winning, draw):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trains NNChess on its games versus Stockfish or itself")
+    parser.add_argument("--selfplay", action="store_true", help="play against itself instead of Stockfish")
+    parser.add_argument("--workers", type=int, default=0, help="self-play worker processes, 0 to play in this one")
+    parser.add_argument("--concurrency", type=int, default=1, help="simultaneous games per process")
+    parser.add_argument("--streaming", action="store_true", help="retrain by streaming stored records")
+    args = parser.parse_args()
+
     sys.setrecursionlimit(10000)
     logging.basicConfig(level=logging.DEBUG if is_debug() else logging.INFO)
+    metrics.enable_from_env()
 
     # if os.path.exists("nn.hdf5"):
     #    os.remove("nn.hdf5")
 
     nn = NNChess("nn.hdf5")
+    if args.workers:
+        play_distributed(nn, args.workers, args.concurrency, not args.selfplay, streaming=args.streaming)
+        sys.exit()
+
     white = NNPLayer("Lisa", WHITE, nn)
-    black = NNPLayer("Karen", BLACK, nn)
-    black = Stockfish(BLACK)
+    black = NNPLayer("Karen", BLACK, nn) if args.selfplay else Stockfish(BLACK)
 
     try:
-        play_with_score(white, black)
+        play_with_score(white, black, nn, args.streaming, args.concurrency)
     finally:
         if isinstance(black, Stockfish):
             black.engine.quit()
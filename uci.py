@@ -1,22 +1,281 @@
+"""
+UCI front end for NNChess, to be used from chess GUIs and tournament managers:
+
+    python uci.py [--model nn.hdf5] [--width 6]
+
+With --versus-stockfish it plays a single game against local Stockfish instead, as it used to.
+"""
+import argparse
 import logging
+import math
 import random
+import sys
+import threading
+import time
 
 import chess
 from chess import WHITE
 from chess.engine import SimpleEngine
 
 from chessnn import BoardOptim, is_debug
-from chessnn.nn import NNChess
-from chessnn.player import NNPLayer
+from chessnn.npnn import load_net
+from chessnn.player import NNPLayer, NNSearchPlayer
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG if is_debug() else logging.INFO)
+ENGINE_NAME = "chess-engine-nn"
+ENGINE_AUTHOR = "chess-engine-nn contributors"
+
+DEFAULT_MOVES_TO_GO = 30
+DEFAULT_MOVE_OVERHEAD = 50  # ms, for GUI and pipe lag
+DEFAULT_TIME_BUDGET = 1.0  # s, when go has no time control at all
+MAX_DEPTH = 64
+MAX_NODES = 200000  # caps tree memory for infinite and ponder searches
+GO_PARAMS = {"wtime", "btime", "winc", "binc", "movestogo", "movetime", "nodes", "depth", "mate"}
+
+
+def allocate_time(remaining, increment=0.0, opponent=None, moves_to_go=None, overhead=DEFAULT_MOVE_OVERHEAD / 1000):
+    """
+    Time to spend on a move, in seconds. Clock values are in seconds as well.
+
+    Splits the clock evenly over the expected remaining moves plus most of the increment, and puts part of the lead
+    over the opponent's clock into the search, never planning to use more than half of what is left.
+    """
+    moves_to_go = moves_to_go or DEFAULT_MOVES_TO_GO
+    budget = remaining / moves_to_go + increment * 0.75
+    if opponent is not None and remaining > opponent:
+        budget += (remaining - opponent) / (2 * moves_to_go)
+
+    usable = max(remaining - overhead, 0.0)
+    cap = usable * 0.9 if moves_to_go == 1 else usable * 0.5
+    return max(min(budget, cap), 0.01)
+
+
+def _value_to_cp(value):
+    """
+    Search values are 2 * eval - 1 for the side to move, eval being a win probability from the NN "eval" head
+    """
+    prob = min(max((value + 1) / 2, 1e-4), 1 - 1e-4)
+    return int(round(400 * math.log10(prob / (1 - prob))))
+
+
+class UCISearchPlayer(NNSearchPlayer):
+
+    def __init__(self, net, output, width=6) -> None:
+        super().__init__("UCI", WHITE, net, width=width, max_depth=MAX_DEPTH)
+        self.output = output
+        self.stop_event = threading.Event()
+        self.started = time.time()
+
+    def on_depth(self):
+        elapsed = time.time() - self.started
+        self.output("info depth %d nodes %d time %d nps %d score cp %d pv %s" % (
+            self.depth, self.nodes, elapsed * 1000, self.nodes / max(elapsed, 1e-3), _value_to_cp(self.score),
+            " ".join(move.uci() for move in self.pv)))
+
+    def stop_requested(self):
+        return self.stop_event.is_set()
+
+    def abort_requested(self):
+        return self.stop_event.is_set()
+
+
+class UCIEngine(object):
+    def __init__(self, model="nn.hdf5", width=6, output=None) -> None:
+        super().__init__()
+        self._output = output or self._print
+        self._output_lock = threading.Lock()
+        self.model = model
+        self.width = width
+        self.move_overhead = DEFAULT_MOVE_OVERHEAD
+        self.chess960 = False
+        self.board = BoardOptim()
+        # noinspection PyTypeChecker
+        self.net = None
+        self.player = None
+        self._search_thr = None
+        self._release = threading.Event()  # lets a finished infinite or ponder search report bestmove
+        self._pondering = False
+        self._ponder_budget = None
+
+        # UCI wants a quick "uciok", so the model loads in background and "isready" waits for it
+        self._loader = threading.Thread(target=self._load, daemon=True)
+        self._loader.start()
+
+    def _print(self, line):
+        with self._output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def _load(self):
+        self.net = load_net(self.model)
+        self.player = UCISearchPlayer(self.net, self._output, self.width)
+        self.player.board = BoardOptim()
+        self.net.inference([self.player.get_inference_record()])  # warm up the predict function
+        logging.info("Model is loaded and warm")
+
+    def loop(self, stream=sys.stdin):
+        for line in stream:
+            if not self.handle(line):
+                break
+        self._stop_search()
 
+    def handle(self, line):
+        """
+        :return: False when the engine should quit
+        """
+        tokens = line.split()
+        if not tokens:
+            return True
+
+        cmd, args = tokens[0], tokens[1:]
+        logging.debug("UCI command: %s", line.strip())
+        if cmd == "uci":
+            self._output("id name %s" % ENGINE_NAME)
+            self._output("id author %s" % ENGINE_AUTHOR)
+            self._output("option name Width type spin default %d min 1 max 64" % self.width)
+            self._output("option name Move Overhead type spin default %d min 0 max 5000" % DEFAULT_MOVE_OVERHEAD)
+            self._output("option name Ponder type check default false")
+            self._output("option name UCI_Chess960 type check default false")
+            self._output("uciok")
+        elif cmd == "isready":
+            self._loader.join()
+            self._output("readyok")
+        elif cmd == "setoption":
+            self._set_option(args)
+        elif cmd == "ucinewgame":
+            self._stop_search()
+            self.board = BoardOptim(chess960=self.chess960)
+        elif cmd == "position":
+            self._stop_search()
+            self._set_position(args)
+        elif cmd == "go":
+            self._stop_search()
+            self._go(args)
+        elif cmd == "stop":
+            self._stop_search()
+        elif cmd == "ponderhit":
+            self._ponderhit()
+        elif cmd == "quit":
+            return False
+        else:
+            logging.warning("Unsupported UCI command: %s", line.strip())
+        return True
+
+    def _set_option(self, args):
+        text = " ".join(args)
+        name, _, value = text.partition(" value ")
+        name = name.replace("name", "", 1).strip().lower()
+        if name == "width":
+            self.width = int(value)
+            self._loader.join()
+            self.player.width = self.width
+        elif name == "move overhead":
+            self.move_overhead = int(value)
+        elif name == "uci_chess960":
+            self.chess960 = value.strip().lower() == "true"
+            self.board.chess960 = self.chess960
+        elif name != "ponder":
+            logging.warning("Unsupported option: %s", text)
+
+    def _set_position(self, args):
+        if "moves" in args:
+            idx = args.index("moves")
+            args, moves = args[:idx], args[idx + 1:]
+        else:
+            moves = []
+
+        if args and args[0] == "fen":
+            self.board = BoardOptim(" ".join(args[1:]), chess960=self.chess960)
+        else:
+            self.board = BoardOptim(chess960=self.chess960)
+
+        for move in moves:
+            self.board.push_uci(move)
+
+    def _go(self, args):
+        params = {}
+        flags = set()
+        idx = 0
+        while idx < len(args):
+            if args[idx] in ("infinite", "ponder"):
+                flags.add(args[idx])
+            elif args[idx] in GO_PARAMS and idx + 1 < len(args):
+                params[args[idx]] = int(args[idx + 1])
+                idx += 1
+            else:
+                logging.debug("Ignoring go argument: %s", args[idx])  # searchmoves and its moves
+            idx += 1
+
+        budget = self._time_budget(params)
+        self._loader.join()
+        player = self.player
+        player.board = self.board.copy()
+        player.color = self.board.turn
+        player.max_depth = params.get("depth", MAX_DEPTH)
+        player.node_budget = params.get("nodes", MAX_NODES)
+        player.stop_event.clear()
+        self._release.clear()
+        self._pondering = "ponder" in flags
+        self._ponder_budget = budget
+        if flags:
+            player.time_budget = math.inf
+        else:
+            player.time_budget = budget
+            self._release.set()
+
+        self._search_thr = threading.Thread(target=self._search, daemon=True)
+        self._search_thr.start()
+
+    def _time_budget(self, params):
+        overhead = self.move_overhead / 1000
+        if "movetime" in params:
+            return max(params["movetime"] / 1000 - overhead, 0.01)
+
+        mine, theirs = ("wtime", "btime") if self.board.turn == chess.WHITE else ("btime", "wtime")
+        if mine not in params:
+            return math.inf if "nodes" in params or "depth" in params else DEFAULT_TIME_BUDGET
+
+        increment = params.get("winc" if self.board.turn == chess.WHITE else "binc", 0) / 1000
+        opponent = params[theirs] / 1000 if theirs in params else None
+        return allocate_time(params[mine] / 1000, increment, opponent, params.get("movestogo"), overhead)
+
+    def _search(self):
+        player = self.player
+        player.started = time.time()
+        move, _, _ = player._choose_best_move()
+        # UCI forbids reporting bestmove of infinite or ponder search before "stop" or "ponderhit"
+        self._release.wait()
+
+        pv = player.pv if player.pv and player.pv[0] == move else [move]
+        if move == chess.Move.null():
+            self._output("bestmove 0000")
+        elif len(pv) > 1:
+            self._output("bestmove %s ponder %s" % (move.uci(), pv[1].uci()))
+        else:
+            self._output("bestmove %s" % move.uci())
+
+    def _ponderhit(self):
+        if not self._pondering:
+            return
+        self._pondering = False
+        # the opponent played the expected move, time spent pondering so far was free
+        self.player.time_budget = time.time() - self.player.started + self._ponder_budget
+        self._release.set()
+
+    def _stop_search(self):
+        if self._search_thr is None:
+            return
+        self.player.stop_event.set()
+        self._release.set()
+        self._search_thr.join()
+        self._search_thr = None
+
+
+def play_versus_stockfish(model):
     engine = SimpleEngine.popen_uci("stockfish")
 
     try:
         board = BoardOptim.from_chess960_pos(random.randint(0, 959))
-        nn = NNChess("nn.hdf5")
+        nn = load_net(model)
         white = NNPLayer("Lisa", WHITE, nn)
         white.board = board
 
@@ -30,3 +289,19 @@ if __name__ == "__main__":
         logging.info("Result: %s", board.result())
     finally:
         engine.quit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UCI chess engine on top of NNChess")
+    parser.add_argument("--model", default="nn.hdf5", help="Keras model, or .npz export to run without TensorFlow")
+    parser.add_argument("--width", type=int, default=6, help="moves searched per node")
+    parser.add_argument("--versus-stockfish", action="store_true", help="play one game against local Stockfish")
+    cli_args = parser.parse_args()
+
+    # stdout belongs to the UCI protocol, logging goes to stderr
+    logging.basicConfig(level=logging.DEBUG if is_debug() else logging.INFO, stream=sys.stderr)
+
+    if cli_args.versus_stockfish:
+        play_versus_stockfish(cli_args.model)
+    else:
+        UCIEngine(cli_args.model, cli_args.width).loop()